@@ -83,6 +83,11 @@ cp -r radioglobe/* /opt/radioglobe/
 echo "Copying stations file..."
 cp stations/stations.json /opt/radioglobe/
 
+# Copy the station health file, if stations/probe_stations.py has been run
+if [[ -f stations/health.json ]]; then
+    cp stations/health.json /opt/radioglobe/
+fi
+
 # Remove any old radioglobe service
 echo "Stopping any existing services..."
 FILE=/etc/systemd/system/radioglobe.service
@@ -1,18 +1,37 @@
 import time
 import threading
 import RPi.GPIO as GPIO
+from events import BUTTON
 
+# Time for the contacts to stop bouncing before the pin is read
+SETTLE_SEC = 0.01
 
-class Button(threading.Thread):
-    def __init__(self, threadID, name, gpio_pin):
-        threading.Thread.__init__(self)
-        self.threadID = threadID
+
+class Button:
+    """A push button, timed from the monotonic timestamps of its GPIO edges.
+
+    A release is reported with how long the button was held.  A button with a hold_sec reports as soon as
+    it has been held that long instead, once something calls check_hold() at the right time, and its
+    release is then ignored.
+    """
+
+    def __init__(self, index, name, gpio_pin, events=None, hold_sec=None, changed=None):
+        self.index = index
         self.name = name
         self.pin = gpio_pin
-        self.held_time = -1
+        # Reports are posted here, if given, as well as being latched for polling
+        self.events = events
+        self.hold_sec = hold_sec
+        # Called after each press and release
+        self.changed = changed
+        self.lock = threading.Lock()
+        self.pressed_at = None
+        self.hold_reported = False
         self.latched_time = -1
         self.last_event_time = 0  # Track last valid event (press or release)
         self.debounce_time = 0.2  # 200ms debounce period (adjustable)
+        # Under the asyncio runtime the pin is read by a loop callback, not after a sleep on the GPIO thread
+        self.device_loop = None
 
         # BCM pin numbering!
         GPIO.setmode(GPIO.BCM)
@@ -26,48 +45,109 @@ class Button(threading.Thread):
         GPIO.cleanup()
 
     def handle_event(self, channel):
-        current_time = time.time()
-        if current_time - self.last_event_time < self.debounce_time:
+        # The edge is timed as it arrives, before waiting for the bounce to settle
+        edge_time = time.monotonic()
+        if edge_time - self.last_event_time < self.debounce_time:
             return  # Ignore if within debounce window
+        self.last_event_time = edge_time
 
         # Wait briefly to let bounce settle, then read pin state
-        time.sleep(0.01)  # 10ms delay to stabilize reading
-        pin_state = GPIO.input(self.pin)
+        if self.device_loop is not None:
+            self.device_loop.call_later(SETTLE_SEC, self.read_pin, edge_time)
+        else:
+            time.sleep(SETTLE_SEC)
+            self.read_pin(edge_time)
 
-        if pin_state == GPIO.LOW:  # Button pressed
-            self.held_time = 0
-            self.latched_time = -1  # Reset latched time until release
-        elif pin_state == GPIO.HIGH and self.held_time >= 0:  # Button released
-            self.latched_time = self.held_time  # Record duration of press
-            self.held_time = -1  # Reset for next press
+    def read_pin(self, edge_time: float):
+        pin_state = GPIO.input(self.pin)
 
-        self.last_event_time = current_time
+        with self.lock:
+            if pin_state == GPIO.LOW:  # Button pressed
+                self.pressed_at = edge_time
+                self.hold_reported = False
+                self.latched_time = -1  # Reset latched time until release
+            elif self.pressed_at is not None:  # Button released
+                held_time = edge_time - self.pressed_at
+                self.pressed_at = None
+                if not self.hold_reported:
+                    self.report(held_time)
+            else:
+                return
+
+        if self.changed is not None:
+            self.changed()
+
+    def report(self, held_time: float):
+        # Call with the lock held
+        self.latched_time = held_time  # Record duration of press
+        if self.events is not None:
+            self.events.post(BUTTON, [self.name, held_time])
+
+    def check_hold(self, now: float):
+        """Report the button if it has been held for hold_sec.  Returns the seconds until it will have been, or
+        None if it isn't being held towards a report.
+        """
+        with self.lock:
+            if self.hold_sec is None or self.pressed_at is None or self.hold_reported:
+                return None
+            held_time = now - self.pressed_at
+            if held_time < self.hold_sec:
+                return self.hold_sec - held_time
+            self.hold_reported = True
+            self.report(held_time)
+            return None
 
     def get_time_held(self):
-        return_val = self.latched_time
-        if self.held_time == -1:  # Clear latch only when button is released
+        with self.lock:
+            return_val = self.latched_time
             self.latched_time = -1
-        return return_val
+            return return_val
 
     def clear(self):
-        self.held_time = -1
-        self.latched_time = -1
-
-    def run(self):
-        while True:
-            if self.held_time >= 0:  # Button is being held
-                self.held_time += 0.01  # Increment by 10ms
-            time.sleep(0.01)  # Check every 10ms for smoother timing
+        with self.lock:
+            self.pressed_at = None
+            self.latched_time = -1
 
 
 class Button_Manager:
-    def __init__(self, name_and_pin_tuples: list):
+    """The buttons, with no threads of their own.
+
+    hold_times gives the buttons that report as soon as they have been held long enough, by name.  One
+    scheduler timer, re-armed for whichever held button is due next, checks them all.  Without a
+    scheduler those buttons report on release like the others.
+    """
+
+    def __init__(
+        self,
+        name_and_pin_tuples: list,
+        events=None,
+        device_loop=None,
+        hold_times: dict = None,
+        scheduler=None,
+    ):
+        self.scheduler = scheduler
+        hold_times = hold_times or {}
         self.buttons = []
         for index, (name, pin) in enumerate(name_and_pin_tuples):
-            self.buttons.append(Button(index, name, pin))
-
-        for button in self.buttons:
-            button.start()
+            button = Button(
+                index, name, pin, events, hold_times.get(name), self.check_holds
+            )
+            button.device_loop = device_loop
+            self.buttons.append(button)
+
+    def check_holds(self):
+        now = time.monotonic()
+        due = [
+            seconds
+            for seconds in (button.check_hold(now) for button in self.buttons)
+            if seconds is not None
+        ]
+        if self.scheduler is None:
+            return
+        if due:
+            self.scheduler.attach_timer(self.check_holds, min(due))
+        else:
+            self.scheduler.cancel_timer(self.check_holds)
 
     def update(self, receiving_queue: list):
         for button in self.buttons:
@@ -1,161 +1,656 @@
 #! /usr/bin/python3
+import hashlib
 import json
+import math
+import mmap
 import os
-import subprocess
+import struct
+import sys
+import time
+from array import array
+from itertools import compress
 from positional_encoders import ENCODER_RESOLUTION
+from spatial_index import Spatial_Index
 import logging
 
 stations_data = {}
+catalog = None
+spatial_index = None
+# Station URL -> whether it was alive when last probed
+station_health = {}
 
-# Make a map representing every possible coordinate, with a 2-byte address for looking up the city, which
-# allows looking up the stations from the regular database.  This reduces the memory required to hold the map
-# to 2 MiB RAM and because the empty space is all 0xFF it can be compressed very easily if desired to just the
-# locations
-index_map = [
-    [0xFFFF for longd in range(0, ENCODER_RESOLUTION)]
-    for lat in range(0, ENCODER_RESOLUTION)
-]
+# Marks a cell of the map with no city
+EMPTY = 0xFFFF
 
+MAP_FILE = "data/map.dat"
+# Written by stations/probe_stations.py and installed next to stations.json.  Optional.
+HEALTH_FILE = "health.json"
+CHECKSUMS_FILE = "data/checksums.json"
 
-def Get_Location_By_Index(index: int):
-    global stations_data
+# Records which index each city was given and where it was stamped, so the map can be updated in place
+MANIFEST_FILE = "data/manifest.json"
 
-    if stations_data == {}:
-        # Load stations database
-        try:
-            with open("stations.json", "r") as stations_file:
-                stations_data = json.load(stations_file)
-            logging.info("Stations data loaded")
-        except Exception as e:
-            logging.error(f"Failed to load stations.json: {e}")
-            raise
-    for loc, idx in enumerate(stations_data.keys()):
-        if loc == index:
-            return idx
-    return "Unknown location"
-
-
-def Get_Checksums():
-    # Produce md5s of the database, so changes can be detected, and the map so corruption can be detected
-    checksums = {}
-    try:
-        md5 = subprocess.run(
-            ["md5sum", "stations.json"], stdout=subprocess.PIPE, check=True
+# map.dat starts with a fixed 64 byte header: magic, format version, encoder resolution and the md5 of the
+# stations.json it was built from.  The grid follows as raw little-endian uint16s, row by row of latitude,
+# so it can be memory-mapped and used without any decoding.
+MAP_MAGIC = b"RGMP"
+MAP_VERSION = 1
+MAP_HEADER = struct.Struct("<4sHH32s24x")
+
+# The original sparse format stores each city cell as latitude, longitude and index
+SPARSE_ENTRY = struct.Struct("<HHH")
+
+
+class Unversioned_Map_Error(ValueError):
+    """The map file has no versioned header, so it may be in the original sparse format"""
+
+
+# Rows of the grid written per chunk when streaming a dense map to disk
+WRITE_CHUNK_ROWS = 64
+
+# Each city is stamped on the map as a square of side 2 * STAMP_RADIUS + 1 cells, centred on its coordinates
+STAMP_RADIUS = 2
+
+
+class Index_Map:
+    """A map representing every possible coordinate, with a 2-byte address for looking up the city.
+
+    The cells are held in one contiguous array of unsigned shorts, row by row of latitude, so the whole
+    map takes 2 MiB RAM.  Because the empty space is all 0xFF it can be compressed very easily if desired
+    to just the locations.
+    """
+
+    def __init__(self, resolution: int = ENCODER_RESOLUTION):
+        self.resolution = resolution
+        self.cells = array("H", [EMPTY]) * (resolution * resolution)
+
+    def clear(self):
+        self.cells = array("H", [EMPTY]) * (self.resolution * self.resolution)
+
+    def attach(self, cells):
+        # Use an existing buffer of cells, such as a memory-mapped map file
+        if len(cells) != self.resolution * self.resolution:
+            raise ValueError(f"Expected {self.resolution ** 2} cells, got {len(cells)}")
+        self.cells = cells
+
+    def get(self, latitude: int, longitude: int):
+        return self.cells[latitude * self.resolution + longitude]
+
+    def set(self, latitude: int, longitude: int, value: int):
+        self.cells[latitude * self.resolution + longitude] = value
+
+    def stamp(self, latitudes, longitudes, values, radius: int = STAMP_RADIUS):
+        # Write a square around each centre cell, wrapping at the edges of the map.  Squares are written in
+        # order, so where two overlap the later value wins.
+        cells = self.cells
+        resolution = self.resolution
+        width = 2 * radius + 1
+        if width > resolution:
+            raise ValueError(f"Stamp radius {radius} is too large for the map")
+        lat_offsets = range(-radius, radius + 1)
+
+        for lat_center, lon_center, value in zip(latitudes, longitudes, values):
+            run = array("H", [value]) * width
+            lat_start = lat_center - radius
+            lon_start = lon_center - radius
+            if 0 <= lon_start <= resolution - width:
+                if 0 <= lat_start <= resolution - width:
+                    # Clear of the edges, so each row of the square is one slice
+                    start = lat_start * resolution + lon_start
+                    for row in range(start, start + width * resolution, resolution):
+                        cells[row : row + width] = run
+                else:
+                    for lat_offset in lat_offsets:
+                        row = ((lat_center + lat_offset) % resolution) * resolution
+                        cells[row + lon_start : row + lon_start + width] = run
+            else:
+                # The square crosses the edge of the map, so split each row and wrap onto the other side
+                lon_start %= resolution
+                split = resolution - lon_start
+                for lat_offset in lat_offsets:
+                    row = ((lat_center + lat_offset) % resolution) * resolution
+                    cells[row + lon_start : row + resolution] = run[:split]
+                    cells[row : row + width - split] = run[split:]
+
+    def read_window(self, coords):
+        # Bulk read of [latitude, longitude] pairs, such as those from Look_Around
+        cells = self.cells
+        resolution = self.resolution
+        return [cells[lat * resolution + lon] for lat, lon in coords]
+
+    def occupied(self):
+        # Yield (latitude, longitude, value) for every cell holding a city
+        cells = self.cells
+        for offset, value in enumerate(cells):
+            if value != EMPTY:
+                yield divmod(offset, self.resolution) + (value,)
+
+
+index_map = Index_Map()
+
+
+def Degrees_To_Cell(degrees: float):
+    # Same conversion the encoders use, wrapped so +180 degrees lands on cell 0
+    return round((degrees + 180) * ENCODER_RESOLUTION / 360) % ENCODER_RESOLUTION
+
+
+def Cell_To_Degrees(cell: int):
+    return 360 * cell / ENCODER_RESOLUTION - 180
+
+
+class Catalog:
+    """The stations database indexed for constant time lookups.
+
+    Every city has an index, which is the value stored in the map.  Indices stay with their cities when
+    stations.json changes, so keys can hold None where a city has been removed.
+    """
+
+    def __init__(self, stations: dict, keys: list = None):
+        self.stations = stations
+        self.keys = list(stations.keys()) if keys is None else keys
+        self.indices = {
+            location: index
+            for index, location in enumerate(self.keys)
+            if location is not None
+        }
+
+        # Per-city coordinates, both in degrees and in encoder cells.  Unused indices are NaN and cell 0.
+        self.latitudes = array(
+            "d",
+            (
+                stations[key]["coords"]["n"] if key is not None else math.nan
+                for key in self.keys
+            ),
+        )
+        self.longitudes = array(
+            "d",
+            (
+                stations[key]["coords"]["e"] if key is not None else math.nan
+                for key in self.keys
+            ),
+        )
+        # Converted in one pass per axis, the same as Degrees_To_Cell
+        scale = ENCODER_RESOLUTION / 360
+        self.cell_latitudes = array(
+            "H",
+            [
+                round((n + 180) * scale) % ENCODER_RESOLUTION if n == n else 0
+                for n in self.latitudes
+            ],
+        )
+        self.cell_longitudes = array(
+            "H",
+            [
+                round((e + 180) * scale) % ENCODER_RESOLUTION if e == e else 0
+                for e in self.longitudes
+            ],
         )
-        checksums["database"] = (
-            str(md5.stdout, encoding="utf8").strip().split()[0]
-        )  # Only the hash
-    except Exception as e:
-        logging.error(f"Failed to get stations.json checksum: {e}")
-        checksums["database"] = "unknown"
-    return checksums  # Only checksum stations.json, not map.dat
 
+    def __len__(self):
+        return len(self.keys)
 
-def Build_Map():
-    global index_map, stations_data
-    logging.info("Rebuilding map from stations.json")
+    def location(self, index: int):
+        if 0 <= index < len(self.keys) and self.keys[index] is not None:
+            return self.keys[index]
+        return "Unknown location"
+
+    def index(self, location: str):
+        return self.indices[location]
+
+    def coords(self, location: str):
+        index = self.indices[location]
+        return self.latitudes[index], self.longitudes[index]
+
+    def cell(self, index: int):
+        return self.cell_latitudes[index], self.cell_longitudes[index]
+
+    def assigned(self):
+        # Indices that hold a city
+        return [index for index, key in enumerate(self.keys) if key is not None]
+
+
+def Assign_Indices(stations: dict, previous_keys: list = None):
+    # Cities keep the index they had before.  New cities take the lowest free index, in stations.json order.
+    if not previous_keys:
+        return list(stations.keys())
+
+    keys = [key if key in stations else None for key in previous_keys]
+    free = [index for index, key in enumerate(keys) if key is None]
+    free.reverse()
+    kept = set(keys)
+    for key in stations:
+        if key not in kept:
+            if free:
+                keys[free.pop()] = key
+            else:
+                keys.append(key)
+
+    while keys and keys[-1] is None:
+        keys.pop()
+    return keys
+
+
+def Load_Catalog(previous_keys: list = None):
+    global stations_data, catalog, spatial_index
     try:
         with open("stations.json", "r") as stations_file:
             stations_data = json.load(stations_file)
-    except FileNotFoundError:
-        logging.error("stations.json not found. Terminating.")
-        exit(1)
+        logging.info("Stations data loaded")
+    except Exception as e:
+        logging.error(f"Failed to load stations.json: {e}")
+        raise
+    catalog = Catalog(stations_data, Assign_Indices(stations_data, previous_keys))
+    spatial_index = Spatial_Index(catalog.latitudes, catalog.longitudes)
+    Load_Health()
+    return catalog
 
-    # Parse every location
-    location_index = 0
-    for location in stations_data:
-        lat_center = round(
-            (stations_data[location]["coords"]["n"] + 180) * ENCODER_RESOLUTION / 360
+
+def Load_Health():
+    global station_health
+    try:
+        with open(HEALTH_FILE, "r") as health_file:
+            station_health = {
+                url: entry["alive"] for url, entry in json.load(health_file).items()
+            }
+        logging.info(
+            f"Station health loaded, {sum(station_health.values())} of {len(station_health)} alive"
         )
-        lon_center = round(
-            (stations_data[location]["coords"]["e"] + 180) * ENCODER_RESOLUTION / 360
+    except FileNotFoundError:
+        station_health = {}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.warning(f"Ignoring unreadable {HEALTH_FILE}: {e}")
+        station_health = {}
+
+
+def Get_Stations(location: str):
+    """Return the stations to offer for location, those found alive first and then any not yet probed.
+
+    Stations found dead are left out, unless that would leave none.
+    """
+    stations = stations_data[location]["urls"]
+    alive = [station for station in stations if station_health.get(station["url"])]
+    unprobed = [station for station in stations if station["url"] not in station_health]
+    return alive + unprobed or list(stations)
+
+
+def Get_Location_By_Index(index: int):
+    if catalog is None:
+        Load_Catalog()
+    return catalog.location(index)
+
+
+def Load_Saved_Checksums():
+    try:
+        with open(CHECKSUMS_FILE, "r") as checksum_file:
+            return json.load(checksum_file)
+    except (json.JSONDecodeError, FileNotFoundError):
+        return {}
+
+
+def Get_Checksums(saved_checksums: dict = None):
+    """Produce the md5 of the database, so changes can be detected.
+
+    The md5 is cached in checksums.json along with the size, modification time and inode of stations.json,
+    and is only recalculated when one of those has changed.
+    """
+    if saved_checksums is None:
+        saved_checksums = Load_Saved_Checksums()
+
+    try:
+        stat = os.stat("stations.json")
+    except OSError as e:
+        logging.error(f"Failed to get stations.json checksum: {e}")
+        return {"database": "unknown"}
+
+    fingerprint = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+    }
+    if saved_checksums.get("fingerprint") == fingerprint:
+        return {"database": saved_checksums["database"], "fingerprint": fingerprint}
+
+    logging.info("stations.json has changed, recalculating checksum")
+    md5 = hashlib.md5()
+    try:
+        with open("stations.json", "rb") as stations_file:
+            while chunk := stations_file.read(1 << 16):
+                md5.update(chunk)
+    except OSError as e:
+        logging.error(f"Failed to get stations.json checksum: {e}")
+        return {"database": "unknown"}
+
+    checksums = {"database": md5.hexdigest(), "fingerprint": fingerprint}
+    try:
+        os.makedirs(os.path.dirname(CHECKSUMS_FILE), exist_ok=True)
+        with open(CHECKSUMS_FILE, "w") as checksum_file:
+            checksum_file.write(json.dumps(checksums))
+    except OSError as e:
+        logging.warning(f"Failed to save checksums: {e}")
+    return checksums  # Only checksum stations.json, not map.dat
+
+
+def Stamp_Cells(latitude: int, longitude: int, radius: int):
+    # The cells of the square stamped for a city centred on the given cell
+    return [
+        (
+            (latitude + lat_offset) % ENCODER_RESOLUTION,
+            (longitude + lon_offset) % ENCODER_RESOLUTION,
         )
-        for lat_offset in range(-2, 3):
-            for lon_offset in range(-2, 3):
-                lat = (lat_center + lat_offset) % ENCODER_RESOLUTION
-                lon = (lon_center + lon_offset) % ENCODER_RESOLUTION
-                index_map[lat][lon] = location_index
-                if location == "Dover,US-DE":
-                    logging.debug(
-                        f"Indexed Dover,US-DE at [{lat}, {lon}] with index {location_index}"
-                    )
-        location_index += 1
+        for lat_offset in range(-radius, radius + 1)
+        for lon_offset in range(-radius, radius + 1)
+    ]
+
+
+def Build_Map(stamp_radius: int = STAMP_RADIUS):
+    logging.info("Rebuilding map from stations.json")
+    if catalog is None:
+        try:
+            Load_Catalog()
+        except FileNotFoundError:
+            logging.error("stations.json not found. Terminating.")
+            exit(1)
+
+    if len(catalog) >= EMPTY:
+        logging.error(f"{len(catalog)} cities will not fit in the map")
+        exit(1)
+
+    # Stamp every location at once, in index order
+    indices = catalog.assigned()
+    index_map.clear()
+    index_map.stamp(
+        [catalog.cell_latitudes[index] for index in indices],
+        [catalog.cell_longitudes[index] for index in indices],
+        indices,
+        stamp_radius,
+    )
+
+    Save_Map()
+    Save_Manifest(stamp_radius)
+
+
+def Update_Map(manifest: dict):
+    """Bring the map up to date with the catalog, re-stamping only the cities added, moved or removed since
+    the manifest was saved.
+    """
+    start = time.perf_counter()
+    if len(catalog) >= EMPTY:
+        logging.error(f"{len(catalog)} cities will not fit in the map")
+        exit(1)
+
+    radius = manifest["stamp_radius"]
+    previous = manifest["cities"]
+
+    # Compare each index with what was stamped for it last time, collecting the cells that may change
+    dirty = set()
+    changed = 0
+    for index in range(max(len(previous), len(catalog))):
+        old_city = previous[index] if index < len(previous) else None
+        if old_city is not None:
+            old_city = (
+                old_city[0],
+                Degrees_To_Cell(old_city[1]),
+                Degrees_To_Cell(old_city[2]),
+            )
+        new_city = catalog.keys[index] if index < len(catalog) else None
+        if new_city is not None:
+            new_city = (new_city,) + catalog.cell(index)
+
+        if old_city != new_city:
+            changed += 1
+            for city in (old_city, new_city):
+                if city is not None:
+                    dirty.update(Stamp_Cells(city[1], city[2], radius))
+
+    if dirty:
+        # A full build stamps in index order, so each cell ends up with the highest index of the cities
+        # centred within the stamp radius of it
+        centres = {}
+        for index in catalog.assigned():
+            centres.setdefault(catalog.cell(index), []).append(index)
+        for lat, lon in dirty:
+            covering = [
+                index
+                for centre in Stamp_Cells(lat, lon, radius)
+                for index in centres.get(centre, ())
+            ]
+            index_map.set(lat, lon, max(covering) if covering else EMPTY)
 
+    logging.info(
+        f"Map updated: {changed} cities changed, {len(dirty)} cells re-stamped in "
+        f"{(time.perf_counter() - start) * 1000:.1f} ms"
+    )
     Save_Map()
+    Save_Manifest(radius)
 
 
-def Save_Map():
-    global index_map
-    logging.info("Saving map to data/map.dat")
-    index_bytes = bytes()
-    for lat in range(0, ENCODER_RESOLUTION):
-        for lon in range(0, ENCODER_RESOLUTION):
-            if index_map[lat][lon] != 0xFFFF:
-                index_bytes += bytes(
-                    [
-                        lat & 0xFF,
-                        (lat >> 8) & 0xFF,
-                        lon & 0xFF,
-                        (lon >> 8) & 0xFF,
-                        index_map[lat][lon] & 0xFF,
-                        (index_map[lat][lon] >> 8) & 0xFF,
-                    ]
+def Save_Manifest(stamp_radius: int = STAMP_RADIUS):
+    manifest = {
+        "database": Get_Checksums()["database"],
+        "resolution": ENCODER_RESOLUTION,
+        "stamp_radius": stamp_radius,
+        "cities": [
+            (
+                [key, catalog.latitudes[index], catalog.longitudes[index]]
+                if key is not None
+                else None
+            )
+            for index, key in enumerate(catalog.keys)
+        ],
+    }
+    try:
+        with open(MANIFEST_FILE + ".tmp", "w") as manifest_file:
+            manifest_file.write(json.dumps(manifest))
+        os.replace(MANIFEST_FILE + ".tmp", MANIFEST_FILE)
+    except Exception as e:
+        logging.error(f"Failed to save manifest: {e}")
+
+
+def Load_Manifest():
+    try:
+        with open(MANIFEST_FILE, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (json.JSONDecodeError, FileNotFoundError):
+        return None
+
+    if manifest.get("resolution") != ENCODER_RESOLUTION or not isinstance(
+        manifest.get("cities"), list
+    ):
+        logging.warning("Manifest does not match this map, ignoring it")
+        return None
+    return manifest
+
+
+def Pack_Sparse_Map():
+    resolution = index_map.resolution
+    empty_row = bytes(array("H", [EMPTY]) * resolution)
+
+    # Find the city cells row by row, skipping the empty rows with a plain byte comparison
+    rows = []
+    total = 0
+    with memoryview(index_map.cells) as cells:
+        for lat in range(resolution):
+            row = cells[lat * resolution : (lat + 1) * resolution]
+            if row.tobytes() != empty_row:
+                values = row.tolist()
+                lons = list(compress(range(resolution), map(EMPTY.__ne__, values)))
+                rows.append((lat, lons, values))
+                total += len(lons)
+
+    # Then pack them all into one preallocated buffer
+    buffer = bytearray(SPARSE_ENTRY.size * total)
+    offset = 0
+    for lat, lons, row in rows:
+        for lon in lons:
+            SPARSE_ENTRY.pack_into(buffer, offset, lat, lon, row[lon])
+            offset += SPARSE_ENTRY.size
+    return buffer
+
+
+def Write_Map(path: str, digest: str = "unknown", sparse: bool = False):
+    """Write index_map to path in a single pass, returning the time taken in seconds.
+
+    The dense format is streamed out in chunks straight from the cells.  The file is written to a
+    temporary name and swapped in, so a map that is currently mapped is never modified.
+    """
+    start = time.perf_counter()
+    resolution = index_map.resolution
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as map_file:
+        if sparse:
+            map_file.write(Pack_Sparse_Map())
+        else:
+            map_file.write(
+                MAP_HEADER.pack(
+                    MAP_MAGIC, MAP_VERSION, resolution, digest.encode("ascii")[:32]
                 )
+            )
+            with memoryview(index_map.cells) as cells:
+                chunk_size = WRITE_CHUNK_ROWS * resolution
+                for offset in range(0, len(cells), chunk_size):
+                    chunk = cells[offset : offset + chunk_size]
+                    if sys.byteorder != "little":
+                        chunk = array("H", chunk)
+                        chunk.byteswap()
+                    map_file.write(chunk)
+    os.replace(path + ".tmp", path)
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"Map written to {path} in {elapsed * 1000:.1f} ms")
+    return elapsed
 
-    # Save the locations to a file
-    os.makedirs("data", exist_ok=True)
+
+def Save_Map(path: str = MAP_FILE):
+    logging.info(f"Saving map to {path}")
+    digest = Get_Checksums()["database"]
     try:
-        with open("data/map.dat", "wb") as locations_file:
-            locations_file.write(index_bytes)
-        checksums = Get_Checksums()
-        with open("data/checksums.json", "w") as checksum_file:
-            checksum_file.write(json.dumps(checksums))
+        Write_Map(path, digest)
         logging.info("Map saved successfully")
     except Exception as e:
         logging.error(f"Failed to save map: {e}")
 
 
+def Open_Map(path: str = MAP_FILE):
+    """Memory-map a map file into index_map and return the stations.json checksum it was built from.
+
+    Raises Unversioned_Map_Error if the file has no header, as with an old sparse map, or ValueError if it
+    is a versioned map that can't be used, such as one of another version or resolution.
+    """
+    with open(path, "rb") as map_file:
+        # A private copy-on-write mapping, so the map can still be edited in memory
+        mapped = mmap.mmap(map_file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    if len(mapped) < MAP_HEADER.size:
+        raise Unversioned_Map_Error(f"{path} is too short for a map header")
+    magic, version, resolution, digest = MAP_HEADER.unpack_from(mapped)
+    if magic != MAP_MAGIC:
+        raise Unversioned_Map_Error(f"{path} is not a versioned map")
+    if version != MAP_VERSION or resolution != index_map.resolution:
+        raise ValueError(f"{path} is version {version}, resolution {resolution}")
+    if len(mapped) != MAP_HEADER.size + 2 * resolution * resolution:
+        raise ValueError(f"{path} is truncated")
+
+    cells = memoryview(mapped)[MAP_HEADER.size :].cast("H")
+    if sys.byteorder != "little":
+        cells = array("H", cells)
+        cells.byteswap()
+    index_map.attach(cells)
+    return digest.decode("ascii")
+
+
+def Import_Sparse_Map(path: str):
+    # The original map format - each location is represented by 6 bytes: latitude, longitude and index,
+    # all little-endian uint16s.  Only cells holding a city are stored.  Raises ValueError or struct.error
+    # if the file isn't one.
+    with open(path, "rb") as map_file:
+        index_bytes = map_file.read()
+
+    index_map.clear()
+    cells = index_map.cells
+    resolution = index_map.resolution
+    for lat, lon, value in SPARSE_ENTRY.iter_unpack(index_bytes):
+        if lat >= resolution or lon >= resolution:
+            index_map.clear()
+            raise ValueError(f"{path} has a cell at {lat}, {lon}, off the map")
+        cells[lat * resolution + lon] = value
+    logging.info(f"Sparse map imported from {path}")
+
+
+def Export_Sparse_Map(path: str):
+    Write_Map(path, sparse=True)
+    logging.info(f"Sparse map exported to {path}")
+
+
 def Load_Map():
-    global index_map
-    current_checksums = Get_Checksums()
+    # Read the saved checksums before they are refreshed, as an old sparse map is only valid for the
+    # stations.json they describe
+    saved_checksums = Load_Saved_Checksums()
+    current_checksums = Get_Checksums(saved_checksums)
+    manifest = Load_Manifest()
+
+    # Load the map data file
+    imported = False
     try:
-        with open("data/checksums.json", "r") as checksum_file:
-            saved_checksums = json.load(checksum_file)
-    except (json.JSONDecodeError, FileNotFoundError):
-        logging.warning("Checksums not found, rebuilding map")
-        Build_Map()
-        return
+        map_checksum = Open_Map()
+    except FileNotFoundError:
+        logging.warning("Map file not found")
+        map_checksum = None
+    except Unversioned_Map_Error as e:
+        logging.warning(f"{e}, trying the sparse format")
+        map_checksum = saved_checksums.get("database", "unknown")
+        manifest = None
+        try:
+            Import_Sparse_Map(MAP_FILE)
+            imported = True
+        except (FileNotFoundError, ValueError, struct.error) as e:
+            logging.warning(f"Map could not be imported: {e}")
+            map_checksum = None
+    except ValueError as e:
+        # A map of another version or resolution is rebuilt rather than guessed at
+        logging.warning(str(e))
+        map_checksum = None
 
-    # Only check stations.json checksum, rebuild if it differs
-    if current_checksums["database"] != saved_checksums.get("database", "unknown"):
-        logging.warning("stations.json checksum mismatch, rebuilding map")
-        Build_Map()
-        return
+    # The manifest is only any use if it describes the map that was loaded
+    if manifest is not None and manifest.get("database") != map_checksum:
+        manifest = None
 
-    # Load the map data file
+    # Load the stations with the indices the map was built with
     try:
-        with open("data/map.dat", "rb") as map_file:
-            index_bytes = map_file.read()
+        Load_Catalog(
+            [city[0] if city else None for city in manifest["cities"]]
+            if manifest
+            else None
+        )
     except FileNotFoundError:
-        logging.warning("Map file not found, rebuilding map")
+        logging.error("stations.json not found. Terminating.")
+        exit(1)
+
+    if map_checksum is None:
+        logging.warning("No usable map, rebuilding map")
         Build_Map()
         return
 
-    # Ensure index_map is empty first
-    index_map = [
-        [0xFFFF for longd in range(0, ENCODER_RESOLUTION)]
-        for lat in range(0, ENCODER_RESOLUTION)
-    ]
+    if manifest is not None and manifest.get("stamp_radius") != STAMP_RADIUS:
+        logging.warning("Stamp radius changed, rebuilding map")
+        Build_Map()
+        return
 
-    # Load the locations from the data file - each is represented by 6 bytes as detailed in Save_Map
-    byte = 0
-    while byte < len(index_bytes):
-        lat = (index_bytes[byte + 1] << 8) | index_bytes[byte]
-        lon = (index_bytes[byte + 3] << 8) | index_bytes[byte + 2]
-        value = (index_bytes[byte + 5] << 8) | index_bytes[byte + 4]
-        byte += 6
-        index_map[lat][lon] = value
-    logging.info("Map loaded successfully from data/map.dat")
+    # Only check stations.json checksum, rebuild if it differs
+    if current_checksums["database"] != map_checksum:
+        if manifest is not None:
+            logging.warning("stations.json checksum mismatch, updating map")
+            Update_Map(manifest)
+        else:
+            logging.warning("stations.json checksum mismatch, rebuilding map")
+            Build_Map()
+        return
+
+    if imported:
+        # Upgrade the file so it can be mapped next time
+        Save_Map()
+    if manifest is None:
+        Save_Manifest()
+    logging.info(f"Map loaded successfully from {MAP_FILE}")
 
 
 def Save_Calibration(latitude: int, longitude: int):
@@ -168,6 +663,27 @@ def Save_Calibration(latitude: int, longitude: int):
         logging.error(f"Failed to save calibration: {e}")
 
 
+def Save_Volume(volume: int):
+    try:
+        with open("data/volume.json", "w") as volume_file:
+            volume_file.write(json.dumps(volume))
+        logging.debug("Volume saved")
+    except Exception as e:
+        logging.error(f"Failed to save volume: {e}")
+
+
+def Load_Volume(default: int = 95):
+    try:
+        with open("data/volume.json", "r") as volume_file:
+            volume = min(max(int(json.load(volume_file)), 0), 100)
+        logging.debug("Volume loaded")
+    except Exception as e:
+        logging.warning(f"Volume load failed: {e}, using default")
+        volume = default
+
+    return volume
+
+
 def Load_Calibration():
     try:
         with open("data/offsets.json", "r") as offsets_file:
@@ -181,10 +697,33 @@ def Load_Calibration():
 
 
 if __name__ == "__main__":
-    Load_Map()
-    Save_Map()
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Inspect and convert RadioGlobe map files"
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("dump", help="Load the map and print every city cell (default)")
+    to_sparse = commands.add_parser(
+        "to-sparse", help="Convert a map to the old 6-byte format"
+    )
+    to_sparse.add_argument("source")
+    to_sparse.add_argument("destination")
+    to_dense = commands.add_parser(
+        "to-dense",
+        help="Convert an old 6-byte map to the mapped format for stations.json",
+    )
+    to_dense.add_argument("source")
+    to_dense.add_argument("destination")
+    args = parser.parse_args()
 
-    for lat in range(ENCODER_RESOLUTION):
-        for lon in range(ENCODER_RESOLUTION):
-            if index_map[lat][lon] != 0xFFFF:
-                print("OUT", lat, lon, index_map[lat][lon])
+    if args.command == "to-sparse":
+        Open_Map(args.source)
+        Export_Sparse_Map(args.destination)
+    elif args.command == "to-dense":
+        Import_Sparse_Map(args.source)
+        Save_Map(args.destination)
+    else:
+        Load_Map()
+        for lat, lon, value in index_map.occupied():
+            print("OUT", lat, lon, value)
@@ -2,16 +2,21 @@ import time
 import threading
 import RPi.GPIO as GPIO
 import logging
+from events import JOG, MODE_TOGGLE
 
 MODE_STATION = "station_select"
 MODE_CITY = "city_select"
+# Edges on the step pin this soon after a step are ignored
+STEP_SETTLE_SEC = 0.3
 
 
 class Dial(threading.Thread):
-    def __init__(self, threadID, name, button_pin=27):
+    def __init__(self, threadID, name, button_pin=27, events=None):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
+        # Steps and mode changes are posted here as they happen, if given, as well as being kept for polling
+        self.events = events
         try:
             GPIO.setmode(GPIO.BCM)
             GPIO.setup([17, 18, button_pin], GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -56,6 +61,8 @@ class Dial(threading.Thread):
                             MODE_CITY if self.mode == MODE_STATION else MODE_STATION
                         )
                         logging.info(f"Mode toggled to {self.mode}")
+                        if self.events is not None:
+                            self.events.post(MODE_TOGGLE, self.mode)
                         self.button_press_time = None
                         logging.debug(
                             f"Jog button released, duration: {press_duration:.2f}s"
@@ -63,18 +70,43 @@ class Dial(threading.Thread):
             except Exception as e:
                 logging.error(f"Button callback failed: {e}")
 
+    def step(self, direction_pin: int):
+        # direction_pin is pin 18 as read at the falling edge of pin 17
+        if direction_pin:
+            new_direction = -1
+        else:
+            new_direction = 1
+        with self.lock:
+            self.direction = new_direction
+        if self.events is not None:
+            self.events.post(JOG, new_direction)
+        logging.debug(f"Dial direction: {new_direction}")
+
     def run(self):
         try:
             while True:
                 GPIO.wait_for_edge(17, GPIO.FALLING)
-                new_direction = GPIO.input(18)
-                if new_direction:
-                    new_direction = -1
-                else:
-                    new_direction = 1
-                with self.lock:
-                    self.direction = new_direction
-                logging.debug(f"Dial direction: {new_direction}")
-                time.sleep(0.3)
+                self.step(GPIO.input(18))
+                time.sleep(STEP_SETTLE_SEC)
         except Exception as e:
             logging.error(f"Dial thread failed: {e}")
+
+    async def run_async(self, device_loop):
+        # Rather than a thread waiting on each edge, the GPIO callback reads the direction straight away and
+        # the loop drops the edges that come too soon after a step
+        last_step = None
+
+        def edge(direction_pin, edge_time):
+            nonlocal last_step
+            if last_step is not None and edge_time - last_step < STEP_SETTLE_SEC:
+                return
+            last_step = edge_time
+            self.step(direction_pin)
+
+        GPIO.add_event_detect(
+            17,
+            GPIO.FALLING,
+            callback=lambda channel: device_loop.call_soon(
+                edge, GPIO.input(18), time.monotonic()
+            ),
+        )
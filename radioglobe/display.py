@@ -1,4 +1,5 @@
 #! /usr/bin/python3
+import asyncio
 import time
 import threading
 import liquidcrystal_i2c
@@ -8,6 +9,9 @@ DISPLAY_I2C_ADDRESS = 0x27
 DISPLAY_I2C_PORT = 1
 DISPLAY_COLUMNS = 20
 DISPLAY_ROWS = 4
+# How long a change stays up before the next one is written, and how often a long station name scrolls
+HOLD_SEC = 1
+SCROLL_INTERVAL_SEC = 0.05
 
 
 class Display(threading.Thread):
@@ -25,27 +29,55 @@ class Display(threading.Thread):
         self.scroll_pos = 0  # Current scroll position
         self.scroll_active = False  # Scrolling state
         self.last_scroll_time = time.time()  # Track time for pauses
+        # Set by the asyncio runtime to wake the display task when the buffer changes
+        self.wake = None
+
+    def write(self):
+        for line_num in range(DISPLAY_ROWS):
+            self.lcd.printline(line_num, self.buffer[line_num])
+        self.changed = False
+        # logging.debug(f"Display updated: {self.buffer}")
 
     def run(self):
         while self.running:
             current_time = time.time()
             if self.changed:
-                for line_num in range(DISPLAY_ROWS):
-                    self.lcd.printline(line_num, self.buffer[line_num])
-                self.changed = False
-                time.sleep(1)  # Hold display for a bit
-                # logging.debug(f"Display updated: {self.buffer}")
+                self.write()
+                time.sleep(HOLD_SEC)  # Hold display for a bit
             if self.scroll_active and len(self.station) > DISPLAY_COLUMNS:
                 self._scroll_station(current_time)
-            time.sleep(0.05)  # 50ms for smooth updates
+            time.sleep(SCROLL_INTERVAL_SEC)  # 50ms for smooth updates
+
+    async def run_async(self, device_loop):
+        # The I2C writes block, so they go to a bus worker.  Unless a station name is scrolling the task
+        # sleeps until the buffer changes.
+        changed = asyncio.Event()
+        self.wake = lambda: device_loop.call_soon(changed.set)
+        while self.running:
+            if self.changed:
+                await device_loop.blocking(self.write)
+                await asyncio.sleep(HOLD_SEC)
+            if self.scroll_active and len(self.station) > DISPLAY_COLUMNS:
+                self._scroll_station(time.time())
+                await asyncio.sleep(SCROLL_INTERVAL_SEC)
+            else:
+                changed.clear()
+                if not self.changed:
+                    await changed.wait()
+
+    def notify(self):
+        if self.wake is not None:
+            self.wake()
 
     def stop(self):
         self.running = False
+        self.notify()
 
     def clear(self):
         self.buffer = [""] * DISPLAY_ROWS
         self.changed = True
         self.scroll_active = False
+        self.notify()
         logging.debug("Display cleared")
 
     def message(
@@ -57,6 +89,7 @@ class Display(threading.Thread):
         self.buffer[3] = line_4.center(DISPLAY_COLUMNS)
         self.changed = True
         self.scroll_active = False
+        self.notify()
         logging.debug(f"Message set: {self.buffer}")
 
     def update(
@@ -98,6 +131,7 @@ class Display(threading.Thread):
         else:
             self.scroll_active = True
         self.changed = True
+        self.notify()
 
     def _scroll_station(self, current_time):
         if not self.scroll_active:
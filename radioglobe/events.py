@@ -0,0 +1,109 @@
+#! /usr/bin/python3
+import queue
+import threading
+import time
+from collections import deque
+
+# Kinds of event, and what their value holds
+POSITION = "Position"  # The encoder readings changed, or the latch came unstuck.  None
+JOG = "Jog"  # The jog dial turned a step.  1 or -1
+MODE_TOGGLE = "Mode_Toggle"  # The jog dial was pushed.  The new mode
+BUTTON = "Button"  # A button was released.  [name, seconds held]
+TIMER = "Timer"  # A scheduler timer expired.  The callback, to be called by whoever takes the event
+DATA_READY = "Data_Ready"  # The stations and map have loaded.  None
+
+# Events caused by someone touching the radio, which are timed through to the display
+INPUTS = (POSITION, JOG, MODE_TOGGLE, BUTTON)
+
+KIND = 0
+VALUE = 1
+POSTED = 2
+
+# How many of the latest input to display times are kept
+LATENCY_HISTORY = 100
+
+
+class Event_Queue:
+    """Events posted by the device threads, taken by the main loop.
+
+    Posting never blocks.  The main loop sleeps in wait() until there is an event or it has something of
+    its own to do, and counts how often it wakes and how long inputs take to reach the display.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        # When the oldest input not yet shown on the display was posted
+        self.pending_input = None
+
+        self.started = time.monotonic()
+        self.wakeups = 0
+        self.posted = 0
+        self.latency_ms = deque(maxlen=LATENCY_HISTORY)
+
+    def post(self, kind: str, value=None):
+        self.queue.put([kind, value, time.monotonic()])
+
+    def wait(self, timeout: float = None):
+        """Return the events posted so far, oldest first, waiting up to timeout seconds for the first.
+
+        A timeout of None waits for as long as it takes, 0 doesn't wait at all.
+        """
+        events = []
+        try:
+            if timeout is None or timeout > 0:
+                # Counted whether an event or the timeout wakes it
+                self.wakeups += 1
+                events.append(self.queue.get(timeout=timeout))
+            while True:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        self.posted += len(events)
+        for event in events:
+            if event[KIND] in INPUTS and self.pending_input is None:
+                self.pending_input = event[POSTED]
+        return events
+
+    def displayed(self):
+        # Called once the display has been given the result of the inputs taken so far
+        if self.pending_input is not None:
+            self.latency_ms.append((time.monotonic() - self.pending_input) * 1000)
+            self.pending_input = None
+
+    def counters(self):
+        latency_ms = sorted(self.latency_ms)
+        return {
+            "wakeups_per_sec": self.wakeups / (time.monotonic() - self.started),
+            "events": self.posted,
+            "median_latency_ms": (
+                latency_ms[len(latency_ms) // 2] if latency_ms else None
+            ),
+            "max_latency_ms": latency_ms[-1] if latency_ms else None,
+        }
+
+
+if __name__ == "__main__":
+    # Time the hand over from a posting thread to a waiting one
+    event_queue = Event_Queue()
+    handed_over = []
+
+    def consumer():
+        while len(handed_over) < 1000:
+            for event in event_queue.wait():
+                handed_over.append((time.monotonic() - event[POSTED]) * 1000)
+
+    thread = threading.Thread(target=consumer)
+    thread.start()
+    for _ in range(1000):
+        event_queue.post(JOG, 1)
+        time.sleep(0.001)
+    thread.join()
+
+    handed_over.sort()
+    print(
+        f"Post to wake: median {handed_over[500]:.3f} ms, max {handed_over[-1]:.3f} ms"
+    )
+    assert event_queue.wait(0) == []
+    print(event_queue.counters())
@@ -1,27 +1,75 @@
 import time
 import subprocess
 import logging
-
-from streaming import Streamer
+import threading
+from array import array
+
+import streaming
+import playlist
+from streaming import Streamer, BACKEND_LIBVLC, STATE_PLAYING, STATE_FAILED
+from supervisor import Supervisor
+from recent import Recent_Stations
 import database
+import metrics
 from display import Display
 from positional_encoders import Positional_Encoders, ENCODER_RESOLUTION
 from ui_manager import UI_Manager
-from rgb_led import RGB_LED
+from rgb_led import RGB_LED, OUTPUT_DIGITAL
 from scheduler import Scheduler
+from events import Event_Queue, KIND, VALUE, TIMER, DATA_READY
+from runtime import Device_Loop, Start_Device, RUNTIME_THREADS, RUNTIME_ASYNCIO
 from urllib.parse import urlsplit, urlunsplit
 from dial import MODE_STATION, MODE_CITY
 
 RADIOGLOBE_VERSION = "1.2.0"
 AUDIO_SERVICE = "pulse"
+# BACKEND_LIBVLC keeps one player and switches stations in place, BACKEND_CVLC starts cvlc for each station
+STREAMING_BACKEND = BACKEND_LIBVLC
+# RUNTIME_THREADS gives each device a thread of its own, RUNTIME_ASYNCIO runs them all on one asyncio
+# event loop, which is lighter on single core Pis
+DEVICE_RUNTIME = RUNTIME_THREADS
+# OUTPUT_DIGITAL switches the LED's pins on and off.  OUTPUT_PWM or OUTPUT_PIGPIO (with pigpiod running)
+# dim them, for mixed colours and fades.
+LED_OUTPUT = OUTPUT_DIGITAL
+# Open the stations either side of the one playing, muted, so jogging to them is instant.  Off by default
+# as each one streams in the background, which costs bandwidth on metered connections.  Needs BACKEND_LIBVLC.
+PREFETCH_ENABLED = False
+# Memory for keeping recently played stations connected, muted, so going back to one is instant.  About
+# 4 MB each, and each one keeps streaming: with the defaults up to 5 streams are open at once, the one
+# playing, 2 prefetched and 2 recent.  0 keeps none, for metered connections or 512 MB Pis.
+RECENT_MEMORY_MB = 8
 VOLUME_INCREMENT = 5
+# Seconds after the last volume press before the level is written to disk
+VOLUME_SAVE_DELAY = 2
+# In station select mode the stream only switches once the jog has rested this long, so spinning
+# through several stations starts just the last one
+JOG_SETTLE_SEC = 0.4
+# City select mode goes back to station select after this long without a jog
+CITY_MODE_TIMEOUT_SEC = 3
+# The main loop sleeps until an event arrives, but while playing it wakes at least this often to check
+# on the stream, and while tuning this often to tidy up
+SUPERVISE_INTERVAL_SEC = 0.5
+HOUSEKEEPING_INTERVAL_SEC = 5
+
+# Cities within this great-circle distance of the reticule are offered in city select mode.  It covers
+# everything the tuning search can find, so the tuned city is always in the list.  With a smaller radius
+# the list may leave it out, and then starts from the nearest city.
+NEARBY_RADIUS_KM = 400
 
 state = "start"
 volume_display = False
 volume = 95
 jog = 0
 last_jog = -1
+jog_direction = 1
+# When the latest jog step arrived, for timing station changes from the user's action
+jog_time = None
+# The jog position whose station is streaming, and when a switch to the current position is due
+playing_jog = 0
+switch_deadline = None
 state_entry = True
+# Set by each pass of the state machine that leaves nothing to do until the next event
+idle = False
 current_mode = MODE_STATION
 nearby_cities = []
 coordinates = [0, 0]
@@ -33,36 +81,80 @@ encoders_thread = None
 display_thread = None
 rgb_led = None
 scheduler = None
+device_loop = None
 streamer = None
+event_queue = Event_Queue()
+supervisor = Supervisor()
+recent_stations = Recent_Stations()
 
+# Set by the loader thread once the stations and map can be used
+data_ready = threading.Event()
 
-# This is used to increase the size of the area searched around the coords
-# For example, fuzziness 2, latitude 50 and longitude 0 will result in a
-# search square 48,1022 to 52,2 (with encoder resolution 1024)
-def Look_Around(latitude: int, longitude: int, fuzziness: int):
-    # Offset fuzziness, so 0 means only the given coords
-    fuzziness += 1
+boot_start = time.monotonic()
+boot_phases = set()
+
+
+def Log_Boot_Phase(phase: str):
+    # Log each step of startup once, against the time since launch, so boot latency can be tracked
+    if phase not in boot_phases:
+        boot_phases.add(phase)
+        logging.info(f"Boot +{time.monotonic() - boot_start:.3f}s: {phase}")
+
+
+def Load_Data():
+    # Runs on its own thread while the hardware comes up
+    try:
+        database.Load_Map()
+    except (Exception, SystemExit) as e:
+        logging.error(f"Failed to load stations: {e}")
+        display_thread.message(
+            line_1="", line_2="Stations failed", line_3="to load", line_4=""
+        )
+        return
+    Log_Boot_Phase("Stations and map loaded")
+    data_ready.set()
+    event_queue.post(DATA_READY)
+
+
+# Relative [latitude, longitude] offsets searched for each fuzziness, worked out on first use
+search_stencils = {}
+
+
+def Get_Search_Stencil(fuzziness: int):
+    stencil = search_stencils.get(fuzziness)
+    if stencil is not None:
+        return stencil
 
-    search_coords = []
+    # Offset fuzziness, so 0 means only the given coords
+    layers = fuzziness + 1
 
-    # Work out how big the perimeter is for each layer out from the origin
-    ODD_NUMBERS = [((i * 2) + 1) for i in range(0, fuzziness)]
+    lat_offsets = array("h")
+    lon_offsets = array("h")
+    seen = set()
 
     # With each 'layer' of fuzziness we need a starting point.  70% of people are right-eye dominant and
     # the globe is likely to be below the user, so go down and left first then scan horizontally, moving up
-    for layer in range(0, fuzziness):
-        for y in range(0, ODD_NUMBERS[layer]):
-            for x in range(0, ODD_NUMBERS[layer]):
-                coord_x = (
-                    latitude + x - (ODD_NUMBERS[layer] // 2)
-                ) % ENCODER_RESOLUTION
-                coord_y = (
-                    longitude + y - (ODD_NUMBERS[layer] // 2)
-                ) % ENCODER_RESOLUTION
-                if [coord_x, coord_y] not in search_coords:
-                    search_coords.append([coord_x, coord_y])
+    for layer in range(0, layers):
+        for y in range(-layer, layer + 1):
+            for x in range(-layer, layer + 1):
+                if (x, y) not in seen:
+                    seen.add((x, y))
+                    lat_offsets.append(x)
+                    lon_offsets.append(y)
+
+    stencil = search_stencils[fuzziness] = (lat_offsets, lon_offsets)
+    return stencil
 
-    return search_coords
+
+# This is used to increase the size of the area searched around the coords
+# For example, fuzziness 2, latitude 50 and longitude 0 will result in a
+# search square 48,1022 to 52,2 (with encoder resolution 1024)
+def Look_Around(latitude: int, longitude: int, fuzziness: int):
+    lat_offsets, lon_offsets = Get_Search_Stencil(fuzziness)
+    return (
+        ((latitude + x) % ENCODER_RESOLUTION, (longitude + y) % ENCODER_RESOLUTION)
+        for x, y in zip(lat_offsets, lon_offsets)
+    )
 
 
 def clean_url(url):
@@ -93,20 +185,18 @@ def clean_url(url):
     return new_url
 
 
-def Get_Nearby_Cities(latitude: int, longitude: int, fuzziness: int = 7):
-    search_coords = Look_Around(latitude, longitude, fuzziness)
-    nearby_cities = []
+def Get_Nearby_Cities(
+    latitude: int, longitude: int, radius_km: float = NEARBY_RADIUS_KM
+):
     logging.debug(
-        f"Searching at coordinates: [{latitude}, {longitude}] with fuzziness {fuzziness}"
+        f"Searching at coordinates: [{latitude}, {longitude}] within {radius_km} km"
     )
-    logging.debug(f"Search area size: {len(search_coords)} coordinates")
-    for ref in search_coords:
-        index = database.index_map[ref[0]][ref[1]]
-        if index != 0xFFFF:
-            location = database.Get_Location_By_Index(index)
-            if location not in nearby_cities:
-                nearby_cities.append(location)
-    nearby_cities.sort()
+    found = database.spatial_index.within(
+        database.Cell_To_Degrees(latitude),
+        database.Cell_To_Degrees(longitude),
+        radius_km,
+    )
+    nearby_cities = sorted(database.catalog.location(index) for _, index in found)
     logging.debug(f"Nearby cities found: {nearby_cities}")
     return nearby_cities
 
@@ -116,7 +206,8 @@ def Back_To_Tuning():
     global state_entry
 
     if state != "tuning":
-        state = "tuning"
+        # Wait on the splash screen if the stations are still loading
+        state = "tuning" if data_ready.is_set() else "start"
         state_entry = True
         logging.debug("Back to tuning state")
 
@@ -128,6 +219,10 @@ def Clear_Volume_Display():
     logging.debug("Volume display cleared")
 
 
+def Save_Volume():
+    database.Save_Volume(volume)
+
+
 def Clear_Mode_Message():
     global state_entry
     state_entry = True
@@ -135,41 +230,138 @@ def Clear_Mode_Message():
     logging.debug("Mode message cleared")
 
 
-def play_first_station(location_name, url_list, stations_list):
-    global streamer
+def play_first_station(
+    location_name, url_list, stations_list, requested_at=None, index=0
+):
+    # index picks another station to start with, such as the one last played in the city
+    global streamer, playing_jog
     if streamer:
         streamer.stop()
-    streamer = Streamer(AUDIO_SERVICE, url_list[0])
+    streamer = Streamer(AUDIO_SERVICE, url_list[index], STREAMING_BACKEND, requested_at)
     streamer.play()
-    logging.info(f"Playing {location_name}, first station: {stations_list[0]}")
+    playing_jog = index
+    supervisor.cancel()
+    Log_Boot_Phase("First station started")
+    logging.info(f"Playing {location_name}, first station: {stations_list[index]}")
+
+
+def Prefetch_Adjacent():
+    # The station (or in city mode, the first station of the city) next in the jog direction comes first
+    if not PREFETCH_ENABLED or STREAMING_BACKEND != BACKEND_LIBVLC:
+        return
+    if current_mode == MODE_CITY:
+        urls = [database.Get_Stations(city)[0]["url"] for city in nearby_cities]
+    else:
+        urls = url_list
+    if len(urls) < 2:
+        return
+    position = jog % len(urls)
+    streaming.Prefetch(
+        AUDIO_SERVICE,
+        [
+            urls[(position + jog_direction) % len(urls)],
+            urls[(position - jog_direction) % len(urls)],
+        ],
+    )
 
 
-def Process_UI_Events():
+def Supervise_Stream():
+    # Move to the next working station of the city if the stream has failed or stalled
+    global streamer, playing_jog, jog, last_jog
+    if streamer is not None:
+        # state() reads the playback clock first, so a stall of the main loop isn't taken for an underrun
+        stream_state = streamer.state()
+        streamer.record_metrics()
+        if stream_state == STATE_PLAYING:
+            supervisor.playing(streamer.url, streamer.played_sec())
+            recent_stations.played(
+                location_name, stations_list[playing_jog], streamer.url
+            )
+            return
+        if stream_state != STATE_FAILED:
+            return
+        supervisor.failed(streamer.url)
+        # The cached stream URL may have gone stale, so the station's playlist is resolved again next time
+        playlist.Forget(streamer.url)
+        streamer.stop()
+        streamer = None
+    elif not supervisor.recovering():
+        return
+
+    # Every station of the city may be backing off, in which case this is tried again on the next pass
+    index = supervisor.next_index(url_list, playing_jog)
+    if index is None:
+        return
+    streamer = Streamer(AUDIO_SERVICE, url_list[index], STREAMING_BACKEND)
+    streamer.play()
+    playing_jog = index
+    if current_mode == MODE_STATION:
+        jog = last_jog = index
+    logging.info(f"Failed over to {stations_list[index]}")
+
+
+def Expire_Recent_Stations():
+    # On a repeating timer, so parked players stop streaming on time whatever state the globe is in
+    streaming.Expire_Recent(AUDIO_SERVICE)
+
+
+def Next_Wakeup():
+    # Seconds the main loop can wait for events before the state machine has work of its own, or None
+    if state_entry or not idle:
+        return 0
+    if state == "tuning":
+        return HOUSEKEEPING_INTERVAL_SEC
+    if state != "playing":
+        return None
+    wakeup = SUPERVISE_INTERVAL_SEC
+    if switch_deadline is not None:
+        wakeup = min(wakeup, switch_deadline - time.monotonic())
+    if current_mode == MODE_CITY and last_activity_time > 0:
+        wakeup = min(wakeup, last_activity_time + CITY_MODE_TIMEOUT_SEC - time.time())
+    return max(wakeup, 0)
+
+
+def Process_UI_Events(timeout: float = 0):
+    # Waits up to timeout seconds for events, then handles every event that has arrived
     global state
     global state_entry
     global volume
     global volume_display
-    global jog
+    global jog, jog_direction, jog_time
     global ui_manager
     global encoders_thread
     global rgb_led
     global current_mode, nearby_cities, coordinates, streamer, last_activity_time
 
-    try:
-        ui_events = []
-        ui_manager.update(ui_events)
-        for event in ui_events:
+    ui_events = []
+    # Each event is handled on its own, so one that fails can't lose the rest of the batch
+    for event in event_queue.wait(timeout):
+        try:
+            if event[KIND] == TIMER:
+                event[VALUE]()
+            else:
+                ui_manager.translate(event, ui_events)
+        except Exception as e:
+            logging.error(f"Event {event[KIND]} failed: {e}")
+
+    # Any number of volume presses taken in one wakeup are applied to the player together, once
+    previous_volume = volume
+    for event in ui_events:
+        try:
             if event[0] == "Jog":
                 if event[1] == 1:
                     jog = (jog + 1) % 20
+                    jog_direction = 1
                 elif event[1] == -1:
                     jog = (jog - 1) % 20
+                    jog_direction = -1
+                jog_time = time.monotonic()
                 logging.debug(f"Jog position: {jog}")
                 last_activity_time = time.time()
 
             elif event[0] == "Volume":
                 if event[1] == 1:
-                    volume += VOLUME_INCREMENT
+                    volume = min(volume + VOLUME_INCREMENT, 100)
                     volume_display = True
                     scheduler.attach_timer(Clear_Volume_Display, 3)
                     rgb_led.set_static("RED", timeout_sec=0.5)
@@ -178,7 +370,7 @@ def Process_UI_Events():
                     if state == "shutdown_confirm":
                         Back_To_Tuning()
                     else:
-                        volume -= VOLUME_INCREMENT
+                        volume = max(volume - VOLUME_INCREMENT, 0)
                         volume_display = True
                         scheduler.attach_timer(Clear_Volume_Display, 3)
                         rgb_led.set_static("RED", timeout_sec=0.5)
@@ -193,6 +385,7 @@ def Process_UI_Events():
                     line_3="",
                     line_4="",
                 )
+                event_queue.displayed()
                 coordinates = encoders_thread.get_readings()
                 if current_mode == MODE_CITY:
                     rgb_led.set_static("GREEN")
@@ -225,6 +418,7 @@ def Process_UI_Events():
                 display_thread.message(
                     line_1="", line_2="Calibrated!", line_3="", line_4=""
                 )
+                event_queue.displayed()
                 logging.info("Calibrated")
                 time.sleep(1)
 
@@ -233,9 +427,13 @@ def Process_UI_Events():
                     state = "shutdown"
                     state_entry = True
                     logging.info("Shutdown confirmed")
+        except Exception as e:
+            logging.error(f"UI event {event[0]} failed: {e}")
 
-    except Exception as e:
-        logging.error(f"UI event processing failed: {e}")
+    if volume != previous_volume:
+        streaming.Set_Volume(AUDIO_SERVICE, volume)
+        # Restarting the timer on each change means only the settled level is written
+        scheduler.attach_timer(Save_Volume, VOLUME_SAVE_DELAY)
 
 
 # PROGRAM START
@@ -245,104 +443,89 @@ logging.getLogger().setLevel(logging.DEBUG)
 
 logging.info(f"Starting RadioGlobe v{RADIOGLOBE_VERSION}")
 
-database.Load_Map()
+if DEVICE_RUNTIME == RUNTIME_ASYNCIO:
+    device_loop = Device_Loop(1, "Devices")
+    device_loop.start()
+    Log_Boot_Phase("Device loop started")
+
+# Get the splash screen up first, then load the stations in the background while everything else starts
+display_thread = Display(3, "Display")
+Start_Device(display_thread, device_loop)
+display_thread.message(
+    line_1="Radio Globe",
+    line_2="Made for DesignSpark",
+    line_3="Jude Pullen, Donald",
+    line_4="Robson, Pete Milne",
+)
+Log_Boot_Phase("Splash screen displayed")
+
+threading.Thread(target=Load_Data, name="Loader", daemon=True).start()
 
 encoder_offsets = database.Load_Calibration()
+volume = database.Load_Volume(volume)
+streaming.Set_Volume(AUDIO_SERVICE, volume)
+# Recent stations keep streaming in the background, so they are off along with prefetching
+streaming.Set_Recent_Memory(RECENT_MEMORY_MB if PREFETCH_ENABLED else 0)
 
 encoders_thread = Positional_Encoders(
-    2, "Encoders", encoder_offsets[0], encoder_offsets[1]
+    2, "Encoders", encoder_offsets[0], encoder_offsets[1], event_queue
 )
-encoders_thread.start()
-logging.info("Encoders thread started")
+Start_Device(encoders_thread, device_loop)
+Log_Boot_Phase("Encoders thread started")
 
-display_thread = Display(3, "Display")
-display_thread.start()
-logging.info("Display thread started")
+rgb_led = RGB_LED(20, "RGB_LED", LED_OUTPUT)
+Start_Device(rgb_led, device_loop)
+Log_Boot_Phase("RGB LED thread started")
 
-rgb_led = RGB_LED(20, "RGB_LED")
-rgb_led.start()
-logging.info("RGB LED thread started")
-
-scheduler = Scheduler(50, "SCHEDULER")
-scheduler.start()
-logging.info("Scheduler thread started")
+scheduler = Scheduler(50, "SCHEDULER", event_queue)
+Start_Device(scheduler, device_loop)
+scheduler.attach_timer(
+    Expire_Recent_Stations, HOUSEKEEPING_INTERVAL_SEC, one_shot=False
+)
+Log_Boot_Phase("Scheduler thread started")
 
-ui_manager = UI_Manager()
-logging.info("UI manager initialized")
+ui_manager = UI_Manager(event_queue, device_loop, scheduler)
+Log_Boot_Phase("UI manager initialized")
 
 while True:
     try:
+        idle = False
         if state == "start":
             if state_entry:
                 state_entry = False
-                display_thread.message(
-                    line_1="Radio Globe",
-                    line_2="Made for DesignSpark",
-                    line_3="Jude Pullen, Donald",
-                    line_4="Robson, Pete Milne",
-                )
-                scheduler.attach_timer(Back_To_Tuning, 5)
-                logging.info("Splash screen displayed")
+                logging.info("Waiting for stations data")
+            elif data_ready.is_set():
+                # Start tuning as soon as the data is ready
+                Back_To_Tuning()
+            else:
+                idle = True
 
         elif state == "tuning":
             if state_entry:
                 state_entry = False
                 rgb_led.set_blink("WHITE")
                 display_thread.clear()
+                Log_Boot_Phase("Tuning")
                 logging.debug("Tuning state entered")
             else:
                 coordinates = encoders_thread.get_readings()
                 search_area = Look_Around(coordinates[0], coordinates[1], fuzziness=5)
-                locations = set()  # Collect unique locations
-                for ref in search_area:
-                    index = database.index_map[ref[0]][ref[1]]
-                    if index != 0xFFFF:
-                        location = database.Get_Location_By_Index(index)
-                        locations.add(location)
-
-                if locations:
-                    if len(locations) == 1:
-                        # Only one city found, use it
-                        location_name = next(iter(locations))
-                    else:
-                        # Multiple cities found, select the closest one
-                        min_distance_sq = float("inf")
-                        closest_location = None
-                        for location in locations:
-                            # Get city coordinates in degrees
-                            city_coords = database.stations_data[location]["coords"]
-                            city_lat_deg = city_coords["n"]
-                            city_lon_deg = city_coords["e"]
-                            # Convert to encoder steps (same as Build_Map)
-                            city_lat_center = round(
-                                (city_lat_deg + 180) * ENCODER_RESOLUTION / 360
-                            )
-                            city_lon_center = round(
-                                (city_lon_deg + 180) * ENCODER_RESOLUTION / 360
-                            )
-                            # Calculate distance considering wrap-around
-                            lat_diff = min(
-                                abs(coordinates[0] - city_lat_center),
-                                ENCODER_RESOLUTION
-                                - abs(coordinates[0] - city_lat_center),
-                            )
-                            lon_diff = min(
-                                abs(coordinates[1] - city_lon_center),
-                                ENCODER_RESOLUTION
-                                - abs(coordinates[1] - city_lon_center),
-                            )
-                            distance_sq = (
-                                lat_diff**2 + lon_diff**2
-                            )  # Squared distance for comparison
-                            if distance_sq < min_distance_sq:
-                                min_distance_sq = distance_sq
-                                closest_location = location
-                        location_name = closest_location
+                # Collect unique locations
+                indices = set(database.index_map.read_window(search_area))
+                indices.discard(database.EMPTY)
+
+                if indices:
+                    # A city is in range, so pick the closest by great-circle distance
+                    closest_index = database.spatial_index.nearest(
+                        database.Cell_To_Degrees(coordinates[0]),
+                        database.Cell_To_Degrees(coordinates[1]),
+                    )
+                    location_name = database.catalog.location(closest_index)
 
                     # Populate stations only from the selected location
                     stations_list = []
                     url_list = []
-                    for station in database.stations_data[location_name]["urls"]:
+                    for station in database.Get_Stations(location_name):
                         stations_list.append(station["name"])
                         url_list.append(station["url"])
                     encoders_thread.latch(coordinates[0], coordinates[1], stickiness=3)
@@ -355,6 +538,8 @@ while True:
                 display_thread.update(
                     latitude, longitude, "Tuning...", volume_disp, "", False
                 )
+                event_queue.displayed()
+                idle = True
                 # logging.debug(f"Tuning: lat={latitude}, lon={longitude}")
 
         elif state == "playing":
@@ -362,16 +547,26 @@ while True:
                 state_entry = False
                 nearby_cities = Get_Nearby_Cities(coordinates[0], coordinates[1])
                 current_city_index = (
-                    0 if not nearby_cities else nearby_cities.index(location_name)
+                    nearby_cities.index(location_name)
+                    if location_name in nearby_cities
+                    else 0
+                )
+                # Coming back to a recent city resumes the station that was playing there
+                resume = recent_stations.last(location_name)
+                station_index = (
+                    url_list.index(resume["url"])
+                    if resume and resume["url"] in url_list
+                    else 0
                 )
                 if current_mode == MODE_STATION:
-                    jog = 0  # Ensure first station plays in MODE_STATION
+                    jog = station_index  # Ensure this station plays in MODE_STATION
                 else:
                     jog = current_city_index  # Use city index in MODE_CITY
                 last_jog = jog - 1
-                latitude = database.stations_data[location_name]["coords"]["n"]
-                longitude = database.stations_data[location_name]["coords"]["e"]
-                play_first_station(location_name, url_list, stations_list)
+                latitude, longitude = database.catalog.coords(location_name)
+                play_first_station(
+                    location_name, url_list, stations_list, index=station_index
+                )
                 if current_mode == MODE_CITY:
                     rgb_led.set_static("GREEN")
                 else:
@@ -381,6 +576,9 @@ while True:
             elif not encoders_thread.is_latched():
                 if streamer:
                     streamer.stop()
+                streaming.Drop_Prefetched(AUDIO_SERVICE)
+                switch_deadline = None
+                supervisor.cancel()
                 state = "tuning"
                 state_entry = True
                 logging.debug("Unlatched, returning to tuning")
@@ -389,11 +587,9 @@ while True:
                 last_jog = jog
                 if current_mode == MODE_STATION:
                     jog %= len(stations_list)
-                    if streamer:
-                        streamer.stop()
-                    streamer = Streamer(AUDIO_SERVICE, url_list[jog])
-                    streamer.play()
-                    logging.debug(f"Station changed: {stations_list[jog]}")
+                    # The display follows every step, the stream waits for the jog to settle.  A
+                    # newer step pushes the deadline back, replacing any switch still pending.
+                    switch_deadline = time.monotonic() + JOG_SETTLE_SEC
                 elif current_mode == MODE_CITY:
                     if nearby_cities:
                         total_cities = len(nearby_cities)
@@ -401,32 +597,37 @@ while True:
                         new_location_name = nearby_cities[current_city_index]
                         if new_location_name != location_name:
                             location_name = new_location_name
-                            stations_list = [
-                                station["name"]
-                                for station in database.stations_data[location_name][
-                                    "urls"
-                                ]
-                            ]
-                            url_list = [
-                                station["url"]
-                                for station in database.stations_data[location_name][
-                                    "urls"
-                                ]
-                            ]
-                            play_first_station(location_name, url_list, stations_list)
-                            latitude = database.stations_data[location_name]["coords"][
-                                "n"
-                            ]
-                            longitude = database.stations_data[location_name]["coords"][
-                                "e"
-                            ]
+                            stations = database.Get_Stations(location_name)
+                            stations_list = [station["name"] for station in stations]
+                            url_list = [station["url"] for station in stations]
+                            play_first_station(
+                                location_name, url_list, stations_list, jog_time
+                            )
+                            latitude, longitude = database.catalog.coords(location_name)
                             jog = current_city_index
                             last_jog = jog - 1
                             logging.debug(
                                 f"City changed: {location_name} (index {current_city_index})"
                             )
+                            Prefetch_Adjacent()
+
+            elif switch_deadline is not None and time.monotonic() >= switch_deadline:
+                switch_deadline = None
+                if current_mode == MODE_STATION:
+                    if jog != playing_jog:
+                        if streamer:
+                            streamer.stop()
+                        streamer = Streamer(
+                            AUDIO_SERVICE, url_list[jog], STREAMING_BACKEND, jog_time
+                        )
+                        streamer.play()
+                        playing_jog = jog
+                        supervisor.cancel()
+                        logging.debug(f"Station changed: {stations_list[jog]}")
+                    Prefetch_Adjacent()
 
             else:
+                Supervise_Stream()
                 volume_disp = volume if volume_display else 0
                 if current_mode == MODE_STATION and len(stations_list) > 1:
                     display_thread.update(
@@ -446,10 +647,12 @@ while True:
                         stations_list[jog % len(stations_list)],
                         False,
                     )
+                event_queue.displayed()
+                idle = True
 
             if current_mode == MODE_CITY and last_activity_time > 0:
                 current_time = time.time()
-                if current_time - last_activity_time >= 3:
+                if current_time - last_activity_time >= CITY_MODE_TIMEOUT_SEC:
                     current_mode = MODE_STATION
                     rgb_led.set_static("OFF")
                     display_thread.message(
@@ -473,8 +676,11 @@ while True:
                     line_3="to confirm or",
                     line_4="<- bottom to cancel.",
                 )
+                event_queue.displayed()
                 scheduler.attach_timer(Back_To_Tuning, 5)
                 logging.info("Shutdown confirm displayed")
+            else:
+                idle = True
 
         elif state == "shutdown":
             if state_entry:
@@ -487,15 +693,18 @@ while True:
                     line_3="before disconnecting",
                     line_4="power.",
                 )
+                metrics.Get_Station_Metrics().save()
+                logging.info(f"Main loop: {event_queue.counters()}")
                 subprocess.run(["sudo", "poweroff"])
                 logging.info("Shutting down")
+            else:
+                idle = True
 
         else:
             state = "tuning"
             logging.debug("Defaulted to tuning state")
 
-        Process_UI_Events()
-        time.sleep(0.1)
+        Process_UI_Events(Next_Wakeup())
 
     except Exception as e:
         logging.error(f"Inner main loop failed: {e}")
@@ -0,0 +1,282 @@
+#! /usr/bin/python3
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+STATION_METRICS_FILE = "data/station_metrics.json"
+
+# Upper edges of the histogram buckets, the last catches everything slower
+BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, math.inf)
+# How many of the latest samples of each timing are kept per station, and how many stations are kept
+ROLLING_SAMPLES = 50
+MAX_STATIONS = 2000
+SAVE_INTERVAL_SEC = 60
+
+# The stages of a tune, in order.  Each timing is from the previous stage that was seen.
+REQUESTED = "requested"  # The jog event, latch or failover that asked for the station
+PLAY = "play"  # Streamer.play called, after any jog settling
+RESOLVED = "resolved"  # Stream URL looked up in the playlist cache
+OPENING = "opening"  # The player started opening the stream: DNS, connecting and HTTP
+BUFFERING = "buffering"  # The stream answered and the player is filling its buffer
+FIRST_AUDIO = "first_audio"  # The first audio was decoded and played
+STAGES = (REQUESTED, PLAY, RESOLVED, OPENING, BUFFERING, FIRST_AUDIO)
+
+TIMINGS = {
+    PLAY: "settle_ms",
+    RESOLVED: "resolve_ms",
+    OPENING: "open_ms",
+    BUFFERING: "connect_ms",
+    FIRST_AUDIO: "buffer_ms",
+}
+TOTAL = "total_ms"
+# Timed by the playlist resolver in the background, rather than during a tune
+DNS = "dns_ms"
+PLAYLIST = "playlist_ms"
+
+
+def Histogram(samples):
+    # Count of samples in each of BUCKETS_MS
+    counts = [0] * len(BUCKETS_MS)
+    for sample in samples:
+        for bucket, edge in enumerate(BUCKETS_MS):
+            if sample <= edge:
+                counts[bucket] += 1
+                break
+    return counts
+
+
+def Median(samples):
+    ordered = sorted(samples)
+    return ordered[len(ordered) // 2] if ordered else None
+
+
+class Station_Metrics:
+    """Rolling timings and audio health for each station, saved to disk for collecting across radios.
+
+    Recorded from the main loop, the resolver and libVLC's event threads, so every method takes the lock.
+    """
+
+    def __init__(self, path: str = STATION_METRICS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stations = OrderedDict()
+        self.dirty = False
+        self.last_save = time.monotonic()
+
+        try:
+            with open(path, "r") as metrics_file:
+                for url, saved in json.load(metrics_file)["stations"].items():
+                    station = self._new_station()
+                    for key in ("tunes", "failures", "cache_hits", "underruns"):
+                        station[key] = saved.get(key, 0)
+                    station["bitrate_kbps"] = saved.get("bitrate_kbps")
+                    for name, samples in saved.get("timings", {}).items():
+                        station["timings"][name] = deque(samples, ROLLING_SAMPLES)
+                    self.stations[url] = station
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.warning(f"Ignoring unreadable station metrics: {e}")
+
+    def _new_station(self):
+        return {
+            "tunes": 0,
+            "failures": 0,
+            "cache_hits": 0,
+            "underruns": 0,
+            "bitrate_kbps": None,
+            "timings": {},
+        }
+
+    def _station(self, url: str):
+        # Call with the lock held
+        station = self.stations.get(url)
+        if station is None:
+            station = self.stations[url] = self._new_station()
+            if len(self.stations) > MAX_STATIONS:
+                self.stations.popitem(last=False)
+        else:
+            self.stations.move_to_end(url)
+        self.dirty = True
+        return station
+
+    def _add_sample(self, station, name: str, milliseconds: float):
+        samples = station["timings"].get(name)
+        if samples is None:
+            samples = station["timings"][name] = deque(maxlen=ROLLING_SAMPLES)
+        samples.append(round(milliseconds))
+
+    def record_tune(self, url: str, stages: dict, cache_hit: bool):
+        with self.lock:
+            station = self._station(url)
+            station["tunes"] += 1
+            station["cache_hits"] += cache_hit
+            previous = stages[REQUESTED]
+            for stage in STAGES[1:]:
+                if stage in stages:
+                    self._add_sample(
+                        station, TIMINGS[stage], (stages[stage] - previous) * 1000
+                    )
+                    previous = stages[stage]
+            if FIRST_AUDIO in stages:
+                self._add_sample(
+                    station, TOTAL, (stages[FIRST_AUDIO] - stages[REQUESTED]) * 1000
+                )
+        self.save_if_due()
+
+    def record_timing(self, url: str, name: str, milliseconds: float):
+        with self.lock:
+            self._add_sample(self._station(url), name, milliseconds)
+
+    def record_failure(self, url: str):
+        with self.lock:
+            self._station(url)["failures"] += 1
+
+    def record_underrun(self, url: str):
+        with self.lock:
+            self._station(url)["underruns"] += 1
+
+    def record_bitrate(self, url: str, kbps: float):
+        with self.lock:
+            self._station(url)["bitrate_kbps"] = round(kbps)
+
+    def export(self):
+        with self.lock:
+            return {
+                "buckets_ms": [
+                    edge if edge != math.inf else None for edge in BUCKETS_MS
+                ],
+                "stations": {
+                    url: {
+                        **{
+                            key: value
+                            for key, value in station.items()
+                            if key != "timings"
+                        },
+                        "timings": {
+                            name: list(samples)
+                            for name, samples in station["timings"].items()
+                        },
+                        "histograms": {
+                            name: Histogram(samples)
+                            for name, samples in station["timings"].items()
+                        },
+                    }
+                    for url, station in self.stations.items()
+                },
+            }
+
+    def save_if_due(self):
+        # Limit the writes to the SD card
+        if time.monotonic() - self.last_save >= SAVE_INTERVAL_SEC:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            self.last_save = time.monotonic()
+            if not self.dirty:
+                return
+            self.dirty = False
+        contents = json.dumps(self.export())
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", "w") as metrics_file:
+                metrics_file.write(contents)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.error(f"Failed to save station metrics: {e}")
+
+
+station_metrics = None
+station_metrics_lock = threading.Lock()
+
+
+def Get_Station_Metrics():
+    global station_metrics
+    with station_metrics_lock:
+        if station_metrics is None:
+            station_metrics = Station_Metrics()
+    return station_metrics
+
+
+class Tune:
+    """The timeline of one station start, from whatever asked for it to the first audio.
+
+    Stages are marked from the main loop and libVLC's event threads, which only note the time.  The tune
+    is recorded by finish(), which is left to the main loop so no file is written on a libVLC thread.
+    """
+
+    def __init__(self, url: str, requested_at: float = None):
+        self.url = url
+        self.stages = {
+            REQUESTED: time.monotonic() if requested_at is None else requested_at
+        }
+        self.cache_hit = False
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def mark(self, stage: str):
+        # Only the first time each stage is reached counts
+        with self.lock:
+            if not self.finished and stage not in self.stages:
+                self.stages[stage] = time.monotonic()
+
+    def heard(self):
+        with self.lock:
+            return FIRST_AUDIO in self.stages
+
+    def finish(self):
+        # Record the tune, only the first time this is called
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            stages = dict(self.stages)
+        if FIRST_AUDIO in stages:
+            logging.info(
+                f"First audio {(stages[FIRST_AUDIO] - stages[REQUESTED]) * 1000:.0f} ms after request: "
+                + ", ".join(
+                    f"{stage} +{(stages[stage] - stages[REQUESTED]) * 1000:.0f}"
+                    for stage in STAGES[1:]
+                    if stage in stages
+                )
+            )
+        Get_Station_Metrics().record_tune(self.url, stages, self.cache_hit)
+
+
+if __name__ == "__main__":
+    # Show the slowest stations in a metrics file: python metrics.py [station_metrics.json ...]
+    import sys
+
+    stations = {}
+    for path in sys.argv[1:] or [STATION_METRICS_FILE]:
+        # Files from several radios are merged
+        with open(path, "r") as metrics_file:
+            for url, station in json.load(metrics_file)["stations"].items():
+                merged = stations.setdefault(
+                    url, {"tunes": 0, "failures": 0, "underruns": 0, "timings": {}}
+                )
+                for key in ("tunes", "failures", "underruns"):
+                    merged[key] += station.get(key, 0)
+                for name, samples in station["timings"].items():
+                    merged["timings"].setdefault(name, []).extend(samples)
+
+    columns = [TOTAL] + list(TIMINGS.values()) + [DNS, PLAYLIST]
+    print(f"{'median ms':>10}" + "".join(f"{name[:-3]:>9}" for name in columns))
+    ranked = sorted(
+        stations.items(),
+        key=lambda item: Median(item[1]["timings"].get(TOTAL, [])) or 0,
+        reverse=True,
+    )
+    for url, station in ranked[:20]:
+        medians = [Median(station["timings"].get(name, [])) for name in columns]
+        print(
+            f"{'':>10}"
+            + "".join(f"{'-' if m is None else m:>9}" for m in medians)
+            + f"  tunes {station['tunes']}, failures {station['failures']}, "
+            f"underruns {station['underruns']}  {url}"
+        )
@@ -0,0 +1,432 @@
+#! /usr/bin/python3
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urljoin, urlsplit
+import metrics
+
+RESOLVED_FILE = "data/resolved.json"
+
+# How long a resolved stream URL is trusted, and how many are kept
+RESOLVE_TTL_SEC = 24 * 60 * 60
+CACHE_SIZE = 1024
+
+RESOLVE_TIMEOUT_SEC = 5
+# Playlists are small, anything bigger is a stream that was mistaken for one
+MAX_PLAYLIST_BYTES = 64 * 1024
+# Playlists may point at further playlists
+MAX_DEPTH = 4
+
+PLAYLIST_TYPES = {
+    "audio/x-mpegurl": "m3u",
+    "audio/mpegurl": "m3u",
+    "application/x-mpegurl": "m3u",
+    "audio/x-scpls": "pls",
+    "audio/scpls": "pls",
+    "application/pls+xml": "pls",
+    "video/x-ms-asf": "asx",
+    "video/x-ms-asx": "asx",
+    "audio/x-ms-asx": "asx",
+}
+PLAYLIST_EXTENSIONS = {".m3u": "m3u", ".pls": "pls", ".asx": "asx"}
+# Content types too vague to rule out a playlist, so the URL's extension decides.  Any other type, audio/*
+# above all, is believed.
+UNTYPED = ("", "application/octet-stream")
+
+EXPIRY = 1
+STREAM_URL = 0
+
+
+def Parse_M3U(text: str):
+    return [
+        line.strip()
+        for line in text.splitlines()
+        if line.strip() and not line.lstrip().startswith("#")
+    ]
+
+
+def Parse_PLS(text: str):
+    # Entries are File1=..., File2=..., in any order
+    entries = []
+    for line in text.splitlines():
+        match = re.match(r"\s*file(\d+)\s*=\s*(\S.*?)\s*$", line, re.IGNORECASE)
+        if match:
+            entries.append((int(match.group(1)), match.group(2)))
+    return [url for _, url in sorted(entries)]
+
+
+def Parse_ASX(text: str):
+    # ASX files are often not well formed XML, so look for the references directly
+    return re.findall(r"<ref\s+href\s*=\s*[\"']([^\"']+)[\"']", text, re.IGNORECASE)
+
+
+PARSERS = {"m3u": Parse_M3U, "pls": Parse_PLS, "asx": Parse_ASX}
+
+
+def Playlist_Format(url: str, content_type: str):
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type in PLAYLIST_TYPES:
+        return PLAYLIST_TYPES[content_type]
+    if content_type not in UNTYPED and not content_type.startswith("text/"):
+        return None
+    path = urlsplit(url).path.lower()
+    for extension, playlist_format in PLAYLIST_EXTENSIONS.items():
+        if path.endswith(extension):
+            return playlist_format
+    return None
+
+
+def Resolve(url: str, depth: int = 0, timeout: float = RESOLVE_TIMEOUT_SEC):
+    """Follow redirects and playlists from url to the stream itself, returning the stream's URL.
+
+    HLS playlists are returned as they are, since the player has to keep reading them.  Raises OSError
+    (including urllib's errors) or ValueError if the URL can't be resolved.
+    """
+    stream_url, response, _ = Open_Stream(url, depth, timeout, open_hls=False)
+    if response is not None:
+        # Closed without reading any of the stream
+        response.close()
+    return stream_url
+
+
+def Open_Stream(
+    url: str,
+    depth: int = 0,
+    timeout: float = RESOLVE_TIMEOUT_SEC,
+    open_hls: bool = True,
+    before_request: callable = None,
+):
+    """Like Resolve(), but returns the stream's URL, its open response and any of its body already read.
+
+    Only an HLS playlist recognised from its contents has been read, and its response is closed.  An HLS
+    playlist known from its .m3u8 name is only opened if open_hls, and otherwise the response is None.
+    before_request, if given, is called with each URL before it is requested.  The caller closes the
+    response.
+    """
+    if depth > MAX_DEPTH:
+        raise ValueError(f"Playlists nested too deeply at {url}")
+    if not open_hls and urlsplit(url).path.lower().endswith(".m3u8"):
+        return url, None, b""
+
+    if before_request is not None:
+        before_request(url)
+    request = urllib.request.Request(url, headers={"User-Agent": "RadioGlobe"})
+    response = urllib.request.urlopen(request, timeout=timeout)
+    try:
+        final_url = response.geturl()
+        playlist_format = Playlist_Format(
+            final_url, response.headers.get("Content-Type", "")
+        )
+        if playlist_format is None:
+            return final_url, response, b""
+        body = response.read(MAX_PLAYLIST_BYTES)
+    except BaseException:
+        response.close()
+        raise
+    response.close()
+
+    text = body.decode("utf-8", errors="replace")
+    if "#EXT-X-" in text:
+        return final_url, response, body
+    entries = [urljoin(final_url, entry) for entry in PARSERS[playlist_format](text)]
+    entries = [
+        entry for entry in entries if urlsplit(entry).scheme in ("http", "https")
+    ]
+    if not entries:
+        raise ValueError(f"No streams in playlist {final_url}")
+    return Open_Stream(entries[0], depth + 1, timeout, open_hls, before_request)
+
+
+class Resolution_Cache:
+    """Resolved stream URLs by station URL, least recently used first, saved to disk as JSON"""
+
+    def __init__(
+        self,
+        path: str = RESOLVED_FILE,
+        ttl_sec: float = RESOLVE_TTL_SEC,
+        size: int = CACHE_SIZE,
+    ):
+        self.path = path
+        self.ttl_sec = ttl_sec
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.dirty = False
+
+        try:
+            with open(path, "r") as cache_file:
+                self.entries.update(json.load(cache_file))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable resolution cache: {e}")
+
+    def get(self, url: str):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            if entry[EXPIRY] <= time.time():
+                del self.entries[url]
+                self.dirty = True
+                return None
+            self.entries.move_to_end(url)
+            return entry[STREAM_URL]
+
+    def put(self, url: str, stream_url: str):
+        with self.lock:
+            self.entries[url] = [stream_url, time.time() + self.ttl_sec]
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def forget(self, url: str):
+        # For a stream URL that stopped working, such as a rotated node or an expired session token
+        with self.lock:
+            if self.entries.pop(url, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            contents = json.dumps(self.entries)
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", "w") as cache_file:
+                cache_file.write(contents)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.error(f"Failed to save resolution cache: {e}")
+
+
+class Resolver(threading.Thread):
+    """Resolves station URLs in the background, filling the cache for the next time they are tuned"""
+
+    def __init__(self, threadID, name, cache: Resolution_Cache):
+        threading.Thread.__init__(self, daemon=True)
+        self.threadID = threadID
+        self.name = name
+        self.cache = cache
+        self.requests = queue.Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+
+    def request(self, url: str):
+        with self.lock:
+            if url in self.queued:
+                return
+            self.queued.add(url)
+        self.requests.put(url)
+
+    def run(self):
+        while True:
+            url = self.requests.get()
+            try:
+                # Time the DNS lookup on its own, to tell it apart from slow servers
+                parts = urlsplit(url)
+                start = time.perf_counter()
+                socket.getaddrinfo(
+                    parts.hostname,
+                    parts.port or (443 if parts.scheme == "https" else 80),
+                )
+                dns_ms = (time.perf_counter() - start) * 1000
+
+                start = time.perf_counter()
+                stream_url = Resolve(url)
+                resolve_ms = (time.perf_counter() - start) * 1000
+                self.cache.put(url, stream_url)
+                station_metrics = metrics.Get_Station_Metrics()
+                station_metrics.record_timing(url, metrics.DNS, dns_ms)
+                station_metrics.record_timing(url, metrics.PLAYLIST, resolve_ms)
+                logging.info(
+                    f"Resolved {url} to {stream_url} in {resolve_ms:.0f} ms, DNS {dns_ms:.0f} ms"
+                )
+            except Exception as e:
+                logging.info(f"Could not resolve {url}: {e}")
+            finally:
+                with self.lock:
+                    self.queued.discard(url)
+
+            # Save once the burst of requests is done, rather than after each one
+            if self.requests.empty():
+                self.cache.save()
+
+
+cache = None
+resolver = None
+resolver_lock = threading.Lock()
+
+
+def Lookup(url: str):
+    """Return the cached stream URL for url without blocking.
+
+    On a miss url itself is returned, for the player to resolve, and it is resolved in the background so
+    that the next tune goes straight to the stream.
+    """
+    global cache, resolver
+    with resolver_lock:
+        if resolver is None:
+            cache = Resolution_Cache()
+            resolver = Resolver(1, "Resolver", cache)
+            resolver.start()
+
+    stream_url = cache.get(url)
+    if stream_url is not None:
+        return stream_url
+    resolver.request(url)
+    return url
+
+
+def Forget(url: str):
+    """Drop the cached stream URL for url, so that the next tune resolves its playlist again"""
+    if cache is not None:
+        cache.forget(url)
+
+
+if __name__ == "__main__":
+    # python playlist.py <url> to resolve a station, or with no arguments to test against a local server
+    import sys
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) > 1:
+        for url in sys.argv[1:]:
+            start = time.perf_counter()
+            print(Resolve(url), f"({(time.perf_counter() - start) * 1000:.0f} ms)")
+        sys.exit(0)
+
+    class Stand_In(BaseHTTPRequestHandler):
+        # path: (status, content type, body), where the body of a redirect is its location
+        routes = {
+            "/station.m3u": (
+                200,
+                "audio/x-mpegurl",
+                "#EXTM3U\n#EXTINF:-1,Test\nstream.mp3\n",
+            ),
+            "/station.pls": (
+                200,
+                "audio/x-scpls",
+                "[playlist]\nNumberOfEntries=2\nFile2=/backup.mp3\nFile1=/stream.mp3\n",
+            ),
+            "/station.asx": (
+                200,
+                "video/x-ms-asf",
+                '<ASX version="3.0"><Entry><REF HREF="/stream.mp3"/></Entry></ASX>',
+            ),
+            "/untyped.pls": (200, "text/plain", "File1=/stream.mp3\n"),
+            "/octet.m3u": (200, "application/octet-stream", "/stream.mp3\n"),
+            # Named like a playlist, but the server says it is audio
+            "/audio.pls": (200, "audio/mpeg", "File1=/stream.mp3\n"),
+            "/nested.m3u": (200, "audio/x-mpegurl", "/station.pls\n"),
+            "/loop.m3u": (200, "audio/x-mpegurl", "/loop.m3u\n"),
+            "/empty.pls": (200, "audio/x-scpls", "[playlist]\nNumberOfEntries=0\n"),
+            "/hls.m3u": (
+                200,
+                "audio/x-mpegurl",
+                "#EXTM3U\n#EXT-X-VERSION:3\nseg1.ts\n",
+            ),
+            "/moved": (302, "text/plain", "/station.pls"),
+            "/stream.mp3": (200, "audio/mpeg", "\xff" * MAX_PLAYLIST_BYTES * 4),
+        }
+        hits = 0
+
+        def do_GET(self):
+            Stand_In.hits += 1
+            status, content_type, body = self.routes.get(
+                self.path, (404, "text/plain", "")
+            )
+            self.send_response(status)
+            if status == 302:
+                self.send_header("Location", body)
+                body = ""
+            self.send_header("Content-Type", content_type)
+            self.end_headers()
+            try:
+                self.wfile.write(body.encode("latin-1"))
+            except ConnectionError:
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Stand_In)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    stream = base + "/stream.mp3"
+
+    for path, expected in [
+        ("/station.m3u", stream),
+        ("/station.pls", stream),
+        ("/station.asx", stream),
+        ("/untyped.pls", stream),
+        ("/octet.m3u", stream),
+        ("/audio.pls", base + "/audio.pls"),
+        ("/nested.m3u", stream),
+        ("/moved", stream),
+        ("/stream.mp3", stream),
+        ("/hls.m3u", base + "/hls.m3u"),
+    ]:
+        assert Resolve(base + path) == expected, path
+    for path in ["/loop.m3u", "/empty.pls"]:
+        try:
+            Resolve(base + path)
+            raise AssertionError(path)
+        except ValueError:
+            pass
+    print("Playlists resolved")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "resolved.json")
+
+        # Least recently used entries go first, and entries expire after the TTL
+        lru = Resolution_Cache(path, ttl_sec=60, size=2)
+        lru.put("a", "A")
+        lru.put("b", "B")
+        lru.get("a")
+        lru.put("c", "C")
+        assert (lru.get("a"), lru.get("b"), lru.get("c")) == ("A", None, "C")
+        lru.entries["a"][EXPIRY] = time.time() - 1
+        assert lru.get("a") is None
+
+        # Entries survive a restart
+        lru.save()
+        assert Resolution_Cache(path).get("c") == "C"
+        print("Cache evicts, expires and persists")
+
+        # A miss plays the station URL and resolves it in the background, a hit goes straight to the stream
+        cache = Resolution_Cache(path)
+        resolver = Resolver(1, "Resolver", cache)
+        resolver.start()
+        assert Lookup(base + "/nested.m3u") == base + "/nested.m3u"
+        deadline = time.monotonic() + 5
+        while cache.get(base + "/nested.m3u") is None:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        hits = Stand_In.hits
+        assert Lookup(base + "/nested.m3u") == stream
+        assert Stand_In.hits == hits
+        print("Lookup resolves in the background and then hits the cache")
+
+        # A stream that failed is forgotten, so the next tune plays the station URL and resolves it again
+        Forget(base + "/nested.m3u")
+        assert Lookup(base + "/nested.m3u") == base + "/nested.m3u"
+        deadline = time.monotonic() + 5
+        while cache.get(base + "/nested.m3u") is None:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert Stand_In.hits > hits
+        print("Forgotten stream URLs are resolved again")
+
+    server.shutdown()
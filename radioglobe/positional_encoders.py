@@ -1,18 +1,28 @@
 #! /usr/bin/python3
+import asyncio
 import time
 import threading
 import spidev
+from events import POSITION
 
 ENCODER_RESOLUTION = 1024
+READ_INTERVAL_SEC = 0.2
 
 
 class Positional_Encoders(threading.Thread):
     def __init__(
-        self, threadID, name, latitude_offset: int = 0, longitude_offset: int = 0
+        self,
+        threadID,
+        name,
+        latitude_offset: int = 0,
+        longitude_offset: int = 0,
+        events=None,
     ):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
+        # Changes to the readings are posted here if given, which includes the latch coming unstuck
+        self.events = events
 
         self.latch_stickiness = None
         self.latitude = 0
@@ -89,32 +99,39 @@ class Positional_Encoders(threading.Thread):
 
         return readings
 
+    def update(self, readings: list):
+        # Returns False when the latch has just come unstuck, for the encoders to be read again straight away
+        if readings:
+            # Invert the latitude reading
+            readings[0] = ENCODER_RESOLUTION - readings[0]
+
+            if self.latch_stickiness is None:
+                # Not 'stuck', so just update the coords
+                moved = readings != [self.latitude, self.longitude]
+                self.latitude = readings[0]
+                self.longitude = readings[1]
+                if moved and self.events is not None:
+                    self.events.post(POSITION)
+            else:
+                # Check to see if the latch should 'come unstuck'
+                lat_difference = abs(self.latitude - readings[0]) % ENCODER_RESOLUTION
+                if lat_difference > self.latch_stickiness:
+                    self.latch_stickiness = None
+                    return False
+
+                lon_difference = abs(self.longitude - readings[1]) % ENCODER_RESOLUTION
+                if lon_difference > self.latch_stickiness:
+                    self.latch_stickiness = None
+                    return False
+        return True
+
     def run(self):
         while True:
-            readings = self.read_spi()
-
-            if readings:
-                # Invert the latitude reading
-                readings[0] = ENCODER_RESOLUTION - readings[0]
-
-                if self.latch_stickiness is None:
-                    # Not 'stuck', so just update the coords
-                    self.latitude = readings[0]
-                    self.longitude = readings[1]
-                else:
-                    # Check to see if the latch should 'come unstuck'
-                    lat_difference = (
-                        abs(self.latitude - readings[0]) % ENCODER_RESOLUTION
-                    )
-                    if lat_difference > self.latch_stickiness:
-                        self.latch_stickiness = None
-                        continue
-
-                    lon_difference = (
-                        abs(self.longitude - readings[1]) % ENCODER_RESOLUTION
-                    )
-                    if lon_difference > self.latch_stickiness:
-                        self.latch_stickiness = None
-                        continue
-
-            time.sleep(0.2)
+            if self.update(self.read_spi()):
+                time.sleep(READ_INTERVAL_SEC)
+
+    async def run_async(self, device_loop):
+        # The SPI transfers block, so they go to a bus worker
+        while True:
+            if self.update(await device_loop.blocking(self.read_spi)):
+                await asyncio.sleep(READ_INTERVAL_SEC)
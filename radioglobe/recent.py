@@ -0,0 +1,47 @@
+#! /usr/bin/python3
+import time
+from collections import OrderedDict
+
+# How many cities' last stations are remembered
+RECENT_CITIES = 16
+
+
+class Recent_Stations:
+    """The station last played in each recently visited city, least recently played first.
+
+    Returning to a city resumes its station, which streaming may still have connected on a muted player.
+    """
+
+    def __init__(self, size: int = RECENT_CITIES):
+        self.size = size
+        self.cities = OrderedDict()
+
+    def played(self, location: str, name: str, url: str):
+        # Called on every pass while a station plays, so an unchanged station is cheap
+        entry = self.cities.get(location)
+        if entry is not None and entry["url"] == url:
+            self.cities.move_to_end(location)
+            return
+        self.cities[location] = {"name": name, "url": url, "played": time.time()}
+        self.cities.move_to_end(location)
+        while len(self.cities) > self.size:
+            self.cities.popitem(last=False)
+
+    def last(self, location: str):
+        """Return the station last played in location as a dict, or None"""
+        return self.cities.get(location)
+
+
+if __name__ == "__main__":
+    recent = Recent_Stations(size=2)
+    recent.played("London", "Radio 1", "http://a")
+    recent.played("Paris", "FIP", "http://b")
+    recent.played("London", "Radio 2", "http://c")
+    recent.played("Berlin", "Radio Eins", "http://d")
+    assert recent.last("Paris") is None
+    assert recent.last("London")["name"] == "Radio 2"
+    # Playing the same station again still counts as recent
+    recent.played("London", "Radio 2", "http://c")
+    recent.played("Rome", "Radio 3", "http://e")
+    assert list(recent.cities) == ["London", "Rome"]
+    print(list(recent.cities.items()))
@@ -1,4 +1,7 @@
 #! /usr/bin/python3
+import asyncio
+import logging
+import math
 import time
 import threading
 import RPi.GPIO as GPIO
@@ -6,6 +9,7 @@ import RPi.GPIO as GPIO
 RED_PIN = 22
 GREEN_PIN = 23
 BLUE_PIN = 24
+PINS = (RED_PIN, GREEN_PIN, BLUE_PIN)
 
 COLOURS = {
     "OFF": None,
@@ -18,59 +22,266 @@ COLOURS = {
     "WHITE": [RED_PIN, GREEN_PIN, BLUE_PIN],
 }
 
+# OUTPUT_DIGITAL switches each pin fully on or off.  OUTPUT_PWM mixes any colour with RPi.GPIO's software
+# PWM, and OUTPUT_PIGPIO with the pigpio daemon's DMA timed PWM, which jitters less and costs less CPU.
+OUTPUT_DIGITAL = "digital"
+OUTPUT_PWM = "pwm"
+OUTPUT_PIGPIO = "pigpio"
+PWM_FREQUENCY_HZ = 200
+# Levels are raised to this power for PWM, so that fades look even
+GAMMA = 2.2
+
+# Each colour of a blink shows for this long
+FLASH_SEC = 0.5
+# Fades and pulses are made of frames this long
+FRAME_SEC = 0.02
+PULSE_PERIOD_SEC = 2
+
+LEVELS = 0
+DURATION = 1
+
+
+def Colour_Levels(colour):
+    """[red, green, blue] levels from 0 to 1 for a name in COLOURS or an (r, g, b) tuple from 0 to 255"""
+    if colour is None:
+        colour = "OFF"
+    if isinstance(colour, str):
+        pins = COLOURS[colour] or []
+        return [1.0 if pin in pins else 0.0 for pin in PINS]
+    return [min(max(value / 255, 0.0), 1.0) for value in colour]
+
+
+def Sequence(frames: list, loop: bool = False, then: list = None):
+    """A pattern for the LED to play.
+
+    frames are [levels, seconds] in order, where the last frame of a sequence that doesn't loop can last
+    None seconds, meaning until something else is played.  then is the sequence to go on to after the
+    last frame.
+    """
+    return [frames, loop, then]
+
+
+def Fade_Frames(start: list, end: list, fade_sec: float):
+    steps = max(round(fade_sec / FRAME_SEC), 1)
+    return [
+        [
+            [a + (b - a) * step / steps for a, b in zip(start, end)],
+            fade_sec / steps,
+        ]
+        for step in range(1, steps + 1)
+    ]
+
+
+def Pulse_Frames(levels: list, period_sec: float):
+    # One breath, from off up to the colour and back down
+    steps = max(round(period_sec / FRAME_SEC), 2)
+    return [
+        [
+            [
+                level * (1 - math.cos(2 * math.pi * step / steps)) / 2
+                for level in levels
+            ],
+            period_sec / steps,
+        ]
+        for step in range(steps)
+    ]
+
+
+def Sequence_Frames(sequence: list, length_sec: float):
+    """The frames of sequence, looped as needed, cut to last length_sec"""
+    frames, loop, then = sequence
+    cut = []
+    remaining = length_sec
+    index = 0
+    while remaining > 1e-9:
+        levels, duration = frames[index]
+        if duration is None or duration >= remaining:
+            cut.append([levels, remaining])
+            break
+        cut.append([levels, duration])
+        remaining -= duration
+        index += 1
+        if index == len(frames):
+            if not loop:
+                # Hold the last frame for the rest of the time
+                cut[-1][DURATION] += remaining
+                break
+            index = 0
+    return cut
+
+
+class Digital_Output:
+    """Each pin is on for a level of a half or more"""
+
+    # Brightness would only switch the pins off, so it is ignored
+    dims = False
+
+    def __init__(self):
+        # BCM pin numbering!
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(list(PINS), direction=GPIO.OUT, initial=GPIO.HIGH)
+        self.states = [GPIO.HIGH] * len(PINS)
+
+    def write(self, levels: list):
+        # Only the pins that change are written
+        for index, level in enumerate(levels):
+            state = GPIO.HIGH if level >= 0.5 else GPIO.LOW
+            if state != self.states[index]:
+                GPIO.output(PINS[index], state)
+                self.states[index] = state
+
+
+class PWM_Output:
+    dims = True
+
+    def __init__(self):
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(list(PINS), direction=GPIO.OUT, initial=GPIO.LOW)
+        self.channels = [GPIO.PWM(pin, PWM_FREQUENCY_HZ) for pin in PINS]
+        for channel in self.channels:
+            channel.start(0)
+        self.duty = [0] * len(PINS)
+
+    def write(self, levels: list):
+        for index, level in enumerate(levels):
+            duty = round(100 * level**GAMMA, 1)
+            if duty != self.duty[index]:
+                self.channels[index].ChangeDutyCycle(duty)
+                self.duty[index] = duty
+
+
+class Pigpio_Output:
+    dims = True
+
+    def __init__(self):
+        import pigpio
+
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise OSError("pigpio daemon not running")
+        for pin in PINS:
+            self.pi.set_PWM_frequency(pin, PWM_FREQUENCY_HZ)
+            self.pi.set_PWM_dutycycle(pin, 0)
+        self.duty = [0] * len(PINS)
+
+    def write(self, levels: list):
+        for index, level in enumerate(levels):
+            duty = round(255 * level**GAMMA)
+            if duty != self.duty[index]:
+                self.pi.set_PWM_dutycycle(PINS[index], duty)
+                self.duty[index] = duty
+
+
+OUTPUTS = {
+    OUTPUT_DIGITAL: Digital_Output,
+    OUTPUT_PWM: PWM_Output,
+    OUTPUT_PIGPIO: Pigpio_Output,
+}
+
 
 class RGB_LED(threading.Thread):
-    def __init__(self, threadID, name):
+    """Plays sequences of frames on the LED, writing the pins only when a frame changes them.
+
+    Every pattern is worked out as frames when it is set, by whichever thread sets it.  The LED's own
+    thread (or task, under the asyncio runtime) is the only one to touch the pins, sleeping until the
+    next frame is due or a new pattern is set.
+    """
+
+    def __init__(
+        self, threadID, name, output: str = OUTPUT_DIGITAL, brightness: float = 1.0
+    ):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
 
-        # BCM pin numbering!
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(
-            [RED_PIN, GREEN_PIN, BLUE_PIN], direction=GPIO.OUT, initial=GPIO.HIGH
-        )
-
-        self.state = 1
-        self.colour_0 = "OFF"
-        self.colour_1 = "OFF"
-        self.colour_0_mem = None
-        self.colour_1_mem = None
+        try:
+            self.output = OUTPUTS[output]()
+        except (ImportError, OSError) as e:
+            # Only pigpio needs more than RPi.GPIO
+            logging.warning(f"LED output {output} unavailable, using PWM: {e}")
+            self.output = PWM_Output()
 
-        self.timer = None
+        self.condition = threading.Condition()
+        self.brightness = brightness
+        self.levels = Colour_Levels("OFF")
+        self.sequence = Sequence([[self.levels, None]])
+        # The latest pattern set without a timeout, which a timed one can go back to
+        self.base = self.sequence
+        self.frame = 0
+        self.frame_due = time.monotonic()
+        # A timed pattern is showing until then, and other timed ones are ignored
+        self.timed_until = 0
+        self.refresh = False
+        # Set by the asyncio runtime to wake the LED task
+        self.wake = None
 
     def __del__(self):
         GPIO.cleanup()
 
-    def set_static(
+    def play(
         self,
-        colour: str = None,
+        sequence: list,
         timeout_sec: float = None,
         restore_previous_on_timeout: bool = False,
     ):
-        if timeout_sec:
-            if self.timer:
-                return
-
-            self.timer = timeout_sec + 0.5
-            if restore_previous_on_timeout:
-                self.colour_0_mem = self.colour_0
-                self.colour_1_mem = self.colour_1
+        """Start sequence straight away.
+
+        With a timeout it plays for that long and then the LED goes off, or back to the pattern from before
+        if restore_previous_on_timeout.  A timed pattern is ignored while another is still playing.
+        """
+        with self.condition:
+            now = time.monotonic()
+            if timeout_sec:
+                if now < self.timed_until:
+                    return
+                self.timed_until = now + timeout_sec
+                if not restore_previous_on_timeout:
+                    # The LED is off once this times out, so that is what a later timed pattern goes back to
+                    self.base = Sequence([[Colour_Levels("OFF"), None]])
+                after = self.base
+                sequence = Sequence(Sequence_Frames(sequence, timeout_sec), then=after)
             else:
-                self.colour_0_mem = None
-                self.colour_1_mem = None
+                self.timed_until = 0
+                self.base = sequence
+            self.sequence = sequence
+            self.frame = 0
+            self.frame_due = now
+            self._notify()
 
-        self.colour_0 = colour
-        self.colour_1 = colour
+    def set_colour(self, colour, fade_sec: float = 0, timeout_sec: float = None):
+        """Show colour, a name in COLOURS or an (r, g, b) tuple from 0 to 255, fading from what is showing"""
+        levels = Colour_Levels(colour)
+        frames = [[levels, None]]
+        if fade_sec:
+            with self.condition:
+                start = self.levels
+            frames = Fade_Frames(start, levels, fade_sec)
+            frames[-1][DURATION] = None
+        self.play(Sequence(frames), timeout_sec)
 
-        pins = COLOURS[colour]
+    def pulse(self, colour, period_sec: float = PULSE_PERIOD_SEC):
+        self.play(Sequence(Pulse_Frames(Colour_Levels(colour), period_sec), loop=True))
 
-        # All pins off (perhaps momentarily)
-        GPIO.output([RED_PIN, GREEN_PIN, BLUE_PIN], GPIO.LOW)
+    def set_brightness(self, brightness: float):
+        if not self.output.dims:
+            logging.warning("LED brightness needs PWM output, ignoring it")
+            return
+        with self.condition:
+            self.brightness = min(max(brightness, 0.0), 1.0)
+            self.refresh = True
+            self._notify()
 
-        # Write required pins high
-        if pins is not None:
-            GPIO.output(pins, GPIO.HIGH)
+    def set_static(
+        self,
+        colour: str = None,
+        timeout_sec: float = None,
+        restore_previous_on_timeout: bool = False,
+    ):
+        self.play(
+            Sequence([[Colour_Levels(colour), None]]),
+            timeout_sec,
+            restore_previous_on_timeout,
+        )
 
     def set_blink(
         self,
@@ -79,61 +290,90 @@ class RGB_LED(threading.Thread):
         timeout_sec: float = None,
         restore_previous_on_timeout: bool = False,
     ):
-        if timeout_sec:
-            if self.timer:
-                return
-
-            self.timer = timeout_sec + 0.5
-            if restore_previous_on_timeout:
-                self.colour_0_mem = self.colour_0
-                self.colour_1_mem = self.colour_1
-            else:
-                self.colour_0_mem = None
-                self.colour_1_mem = None
+        self.play(
+            Sequence(
+                [
+                    [Colour_Levels(colour_0), FLASH_SEC],
+                    [Colour_Levels(colour_1), FLASH_SEC],
+                ],
+                loop=True,
+            ),
+            timeout_sec,
+            restore_previous_on_timeout,
+        )
 
-        self.colour_0 = colour_0
-        self.colour_1 = colour_1
+    def _notify(self):
+        # Call with the condition held
+        self.condition.notify()
+        if self.wake is not None:
+            self.wake()
 
-    def run(self):
-        while True:
-            if self.state == 0:
-                self.state = 1
-                pins = COLOURS[self.colour_1]
-            else:
-                self.state = 0
-                pins = COLOURS[self.colour_0]
-
-            # All pins off (perhaps momentarily)
-            GPIO.output([RED_PIN, GREEN_PIN, BLUE_PIN], GPIO.LOW)
+    def _next_frame(self):
+        """Call with the condition held.  Returns the levels to show if a frame is due, or None, and the
+        seconds until the next frame (None if there are no more).
+        """
+        now = time.monotonic()
+        if self.refresh:
+            self.refresh = False
+            return self.levels, self._due_in(now)
+        if self.frame_due is None or now < self.frame_due:
+            return None, self._due_in(now)
 
-            # Write required pins high
-            if pins is not None:
-                GPIO.output(pins, GPIO.HIGH)
+        frames, loop, then = self.sequence
+        levels, duration = frames[self.frame]
+        self.frame += 1
+        if self.frame == len(frames):
+            self.frame = 0
+            if not loop:
+                if then is not None:
+                    self.sequence = then
+                else:
+                    duration = None
+        if duration is None:
+            self.frame_due = None
+        else:
+            # Keep to the sequence's timing, unless the frames have fallen behind
+            self.frame_due = max(self.frame_due + duration, now)
+        self.levels = levels
+        return levels, self._due_in(now)
 
-            # Flash/wait period
-            time.sleep(0.5)
+    def _due_in(self, now: float):
+        return None if self.frame_due is None else max(self.frame_due - now, 0)
 
-            # Turn off the light when the timer expires
-            if self.timer:
-                self.timer -= 0.5
+    def show(self, levels: list):
+        if self.output.dims:
+            levels = [level * self.brightness for level in levels]
+        self.output.write(levels)
 
-                if self.timer <= 0:
-                    self.timer = None
-                    if self.colour_0_mem:
-                        self.colour_0 = self.colour_0_mem
-                        self.colour_0_mem = None
-                    else:
-                        self.colour_0 = "OFF"
+    def run(self):
+        while True:
+            with self.condition:
+                levels, delay = self._next_frame()
+                while levels is None:
+                    self.condition.wait(delay)
+                    levels, delay = self._next_frame()
+            self.show(levels)
 
-                    if self.colour_1_mem:
-                        self.colour_1 = self.colour_1_mem
-                        self.colour_1_mem = None
-                    else:
-                        self.colour_1 = "OFF"
+    async def run_async(self, device_loop):
+        # Writing the pins doesn't block, so the frames are shown from the loop itself
+        changed = asyncio.Event()
+        self.wake = lambda: device_loop.call_soon(changed.set)
+        while True:
+            with self.condition:
+                # Cleared with the lock held, so a pattern set from now on sets it again
+                changed.clear()
+                levels, delay = self._next_frame()
+            if levels is not None:
+                self.show(levels)
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
 
 
 if __name__ == "__main__":
-    led = RGB_LED(1, "LED")
+    led = RGB_LED(1, "LED", OUTPUT_PWM)
     led.start()
 
     try:
@@ -145,6 +385,19 @@ if __name__ == "__main__":
                 led.set_static(colour)
                 time.sleep(0.5)
 
+            # Flash red for a second, then back to blinking
+            led.set_blink("WHITE")
+            led.set_static("RED", timeout_sec=1, restore_previous_on_timeout=True)
+            time.sleep(3)
+
+            led.set_colour((255, 96, 0), fade_sec=1)
+            time.sleep(2)
+            led.pulse("CYAN")
+            time.sleep(4)
+            led.set_brightness(0.25)
+            time.sleep(4)
+            led.set_brightness(1)
+
     except Exception:
         GPIO.cleanup()
         exit()
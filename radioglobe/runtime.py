@@ -0,0 +1,66 @@
+#! /usr/bin/python3
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# RUNTIME_THREADS runs each device on a thread of its own.  RUNTIME_ASYNCIO runs them all as tasks on one
+# asyncio event loop, which saves threads and context switches on single core Pis.
+RUNTIME_THREADS = "threads"
+RUNTIME_ASYNCIO = "asyncio"
+
+# Threads for blocking SPI and I2C transfers, so they don't hold up the event loop
+BUS_WORKERS = 2
+
+
+class Device_Loop(threading.Thread):
+    """An asyncio event loop on its own thread, for running the devices as tasks.
+
+    Everything here can be called from any thread.
+    """
+
+    def __init__(self, threadID, name):
+        threading.Thread.__init__(self, daemon=True)
+        self.threadID = threadID
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(BUS_WORKERS, thread_name_prefix="Bus")
+        self.loop.set_default_executor(self.executor)
+        self.tasks = set()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def add(self, coroutine):
+        # Run coroutine as a task on the loop
+        self.loop.call_soon_threadsafe(self._create_task, coroutine)
+
+    def _create_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        # The loop only keeps weak references to tasks
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Device task failed: {task.exception()!r}")
+
+    def call_soon(self, callback: callable, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def call_later(self, delay_sec: float, callback: callable, *args):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay_sec, callback, *args)
+
+    def blocking(self, function: callable, *args):
+        # Await this from the loop to run function on a bus worker thread
+        return self.loop.run_in_executor(None, function, *args)
+
+
+def Start_Device(device, device_loop: Device_Loop = None):
+    """Start a device on its own thread, or as a task on device_loop if one is given"""
+    if device_loop is None:
+        device.start()
+    else:
+        device_loop.add(device.run_async(device_loop))
@@ -1,81 +1,183 @@
 #! /usr/bin/python3
+import asyncio
+import heapq
 import time
 import threading
+from events import TIMER
 
+# Timers are kept in a heap ordered by expiry, with the sequence number breaking ties in the order attached
 EXPIRY = 0
-RELOAD = 1
-CALLBACK = 2
+SEQUENCE = 1
+RELOAD = 2
+CALLBACK = 3
 
 
 class Scheduler(threading.Thread):
-    def __init__(self, threadID, name):
+    """Calls callbacks after a delay, or repeatedly, on its own thread.
+
+    Times are in seconds on the monotonic clock and can be fractional.  The thread sleeps until the next
+    timer is due, or a new timer is attached.  Given an event queue, expired timers are posted to it as
+    TIMER events instead, for the callbacks to be called on the thread that takes them.
+    """
+
+    def __init__(self, threadID, name, events=None):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
+        self.events = events
 
-        self.time = 0
+        self.condition = threading.Condition()
         self.timers = []
+        # Callback -> its live timer in the heap.  Replaced or cancelled timers are marked by clearing their
+        # callback and are dropped when they reach the top of the heap.
+        self.handles = {}
+        self.sequence = 0
+        # Set by the asyncio runtime to wake the scheduler task, in place of notifying the condition
+        self.wake = None
+
+    def _push(self, callback: callable, expiry: float, reload: float):
+        # Call with the condition held
+        self.sequence += 1
+        timer = [expiry, self.sequence, reload, callback]
+        heapq.heappush(self.timers, timer)
+        self.handles[callback] = timer
+        # Wake the thread in case this timer is due before the one it is waiting for
+        self.condition.notify()
+        if self.wake is not None:
+            self.wake()
 
     def attach_timer(
-        self, callback: callable, initial_value_sec: int, one_shot: bool = True
+        self, callback: callable, initial_value_sec: float, one_shot: bool = True
     ):
-        # Overwrite existing timer for the same callback
-        for exist_timer in self.timers:
-            if exist_timer[CALLBACK] == callback:
-                exist_timer[EXPIRY] = self.time + initial_value_sec
-                if not one_shot:
-                    exist_timer[RELOAD] = initial_value_sec
-                return
-
-        # Else make a new timer
-        new_timer = [None, None, None]
-        new_timer[EXPIRY] = self.time + initial_value_sec
-        new_timer[CALLBACK] = callback
-        if not one_shot:
-            new_timer[RELOAD] = initial_value_sec
-        self.timers.append(new_timer)
+        with self.condition:
+            reload = None
+            # Overwrite existing timer for the same callback
+            exist_timer = self.handles.pop(callback, None)
+            if exist_timer is not None:
+                exist_timer[CALLBACK] = None
+                reload = exist_timer[RELOAD]
+            if not one_shot:
+                reload = initial_value_sec
+            self._push(callback, time.monotonic() + initial_value_sec, reload)
+
+    def cancel_timer(self, callback: callable):
+        # Returns True if the callback had a timer
+        with self.condition:
+            exist_timer = self.handles.pop(callback, None)
+            if exist_timer is None:
+                return False
+            exist_timer[CALLBACK] = None
+            return True
+
+    def reschedule_timer(self, callback: callable, delay_sec: float):
+        """Move an existing timer to delay_sec from now, keeping its reload.  Returns False if there is none."""
+        with self.condition:
+            exist_timer = self.handles.pop(callback, None)
+            if exist_timer is None:
+                return False
+            exist_timer[CALLBACK] = None
+            self._push(callback, time.monotonic() + delay_sec, exist_timer[RELOAD])
+            return True
+
+    def _take_expired(self):
+        """Call with the condition held.  Returns the callback of the first timer if it has expired, otherwise
+        None and the seconds until it does (None if there are no timers).
+        """
+        # Throw away replaced and cancelled timers
+        while self.timers and self.timers[0][CALLBACK] is None:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None, None
+        delay = self.timers[0][EXPIRY] - time.monotonic()
+        if delay > 0:
+            return None, delay
+
+        timer = heapq.heappop(self.timers)
+        callback = timer[CALLBACK]
+        del self.handles[callback]
+        if timer[RELOAD]:
+            # Keep to the original period, unless the callbacks have fallen a whole period behind
+            expiry = max(timer[EXPIRY] + timer[RELOAD], time.monotonic())
+            self._push(callback, expiry, timer[RELOAD])
+        return callback, 0
+
+    def _expire(self, callback: callable):
+        if self.events is not None:
+            self.events.post(TIMER, callback)
+        else:
+            # Called without the lock, so callbacks can attach timers
+            callback()
 
     def run(self):
         while True:
-            time.sleep(1)
-            self.time += 1
-
-            # Loop all the timers to see if they've expired.  Call their callback if they have, then delete if they're
-            # one shot timers
-            num_timers = len(self.timers)
-            timer = 0
-            while timer < num_timers:
-                if self.time >= self.timers[timer][EXPIRY]:
-                    self.timers[timer][CALLBACK]()
-                    if self.timers[timer][RELOAD]:
-                        self.timers[timer][EXPIRY] = (
-                            self.time + self.timers[timer][RELOAD]
-                        )
-                    else:
-                        self.timers.__delitem__(timer)
-                        num_timers -= 1
-                timer += 1
+            with self.condition:
+                callback, delay = self._take_expired()
+                while callback is None:
+                    self.condition.wait(delay)
+                    callback, delay = self._take_expired()
+            self._expire(callback)
+
+    async def run_async(self, device_loop):
+        attached = asyncio.Event()
+        self.wake = lambda: device_loop.call_soon(attached.set)
+        while True:
+            with self.condition:
+                # Cleared with the lock held, so a timer attached from now on sets it again
+                attached.clear()
+                callback, delay = self._take_expired()
+            if callback is not None:
+                self._expire(callback)
+                continue
+            try:
+                await asyncio.wait_for(attached.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
 
 
 if __name__ == "__main__":
+    start = time.monotonic()
 
     def print_one_shot():
-        print("One shot")
+        print(f"{time.monotonic() - start:6.3f} One shot")
 
     def print_reload():
-        print("Reload")
+        print(f"{time.monotonic() - start:6.3f} Reload")
+
+    def print_short():
+        print(f"{time.monotonic() - start:6.3f} Short")
+
+    def print_cancelled():
+        print("Cancelled timer fired!")
 
     scheduler = Scheduler(1, "SCHEDULER")
+    scheduler.daemon = True
     scheduler.start()
 
     # The first one shouldn't expire, because the second overwrites it!
     scheduler.attach_timer(print_one_shot, 5)
     scheduler.attach_timer(print_one_shot, 8)
     scheduler.attach_timer(print_reload, 6, one_shot=False)
+    # Sub-second timers
+    scheduler.attach_timer(print_short, 0.25, one_shot=False)
+    scheduler.attach_timer(print_cancelled, 0.5)
+    scheduler.cancel_timer(print_cancelled)
+    scheduler.attach_timer(lambda: scheduler.cancel_timer(print_short), 1.1)
+
+    # Attach and cancel cost with many timers waiting
+    callbacks = [lambda: None for _ in range(10000)]
+    attach_start = time.perf_counter()
+    for number, callback in enumerate(callbacks):
+        scheduler.attach_timer(callback, 100 + number)
+    for callback in callbacks:
+        scheduler.reschedule_timer(callback, 200)
+    for callback in callbacks:
+        scheduler.cancel_timer(callback)
+    print(
+        f"Attach, reschedule and cancel: {(time.perf_counter() - attach_start) / 30000 * 1e6:.1f} us each"
+    )
 
     try:
-        while True:
-            time.sleep(0.5)
+        time.sleep(13)
 
     except KeyboardInterrupt:
         exit()
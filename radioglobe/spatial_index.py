@@ -0,0 +1,202 @@
+#! /usr/bin/python3
+import math
+
+EARTH_RADIUS_KM = 6371.0
+
+# Size of each bucket of the grid, in degrees of latitude and longitude
+BUCKET_DEGREES = 2
+
+
+def Haversine_Km(
+    latitude_1: float, longitude_1: float, latitude_2: float, longitude_2: float
+):
+    # Great-circle distance between two points given in degrees
+    lat_1 = math.radians(latitude_1)
+    lat_2 = math.radians(latitude_2)
+    half_dlat = (lat_2 - lat_1) / 2
+    half_dlon = math.radians(longitude_2 - longitude_1) / 2
+    a = (
+        math.sin(half_dlat) ** 2
+        + math.cos(lat_1) * math.cos(lat_2) * math.sin(half_dlon) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Spatial_Index:
+    """Cities bucketed on a latitude/longitude grid, for nearest and radius queries by great-circle distance.
+
+    Cities are referred to by their index in the latitude and longitude sequences, the same index as the
+    catalog and the map.  A NaN latitude marks an unused index.
+    """
+
+    def __init__(self, latitudes, longitudes, bucket_degrees: float = BUCKET_DEGREES):
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.bucket_degrees = bucket_degrees
+        self.rows = math.ceil(180 / bucket_degrees)
+        self.columns = math.ceil(360 / bucket_degrees)
+
+        self.buckets = {}
+        for index, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            if not math.isnan(latitude):
+                self.buckets.setdefault(self._bucket(latitude, longitude), []).append(
+                    index
+                )
+
+    def _row(self, latitude: float):
+        return min(max(int((latitude + 90) // self.bucket_degrees), 0), self.rows - 1)
+
+    def _column(self, longitude: float):
+        return int((longitude + 180) // self.bucket_degrees) % self.columns
+
+    def _bucket(self, latitude: float, longitude: float):
+        return self._row(latitude), self._column(longitude)
+
+    def _candidates(self, latitude: float, longitude: float, radius_km: float):
+        # Yield every city in the buckets that could hold points within radius_km
+        angle = radius_km / EARTH_RADIUS_KM
+        lat_span = math.degrees(angle)
+        first_row = self._row(latitude - lat_span)
+        last_row = self._row(latitude + lat_span)
+
+        # Lines of longitude converge towards the poles, so the longitude span widens with latitude
+        cos_lat = math.cos(math.radians(latitude))
+        if (
+            latitude + lat_span >= 90
+            or latitude - lat_span <= -90
+            or math.sin(angle) >= cos_lat
+        ):
+            # A pole is within reach, so every longitude is too
+            columns = range(self.columns)
+        else:
+            lon_span = math.degrees(math.asin(math.sin(angle) / cos_lat))
+            first_column = self._column(longitude - lon_span)
+            count = min(int(2 * lon_span // self.bucket_degrees) + 2, self.columns)
+            columns = [
+                (first_column + offset) % self.columns for offset in range(count)
+            ]
+
+        for row in range(first_row, last_row + 1):
+            for column in columns:
+                yield from self.buckets.get((row, column), ())
+
+    def within(self, latitude: float, longitude: float, radius_km: float):
+        """Return [distance_km, index] for every city within radius_km, nearest first"""
+        found = []
+        for index in self._candidates(latitude, longitude, radius_km):
+            distance = Haversine_Km(
+                latitude, longitude, self.latitudes[index], self.longitudes[index]
+            )
+            if distance <= radius_km:
+                found.append([distance, index])
+        found.sort()
+        return found
+
+    def nearest(self, latitude: float, longitude: float, max_km: float = None):
+        """Return the index of the nearest city, or None if there is none within max_km"""
+        if not self.buckets:
+            return None
+        half_circumference = math.pi * EARTH_RADIUS_KM
+        limit = (
+            half_circumference if max_km is None else min(max_km, half_circumference)
+        )
+
+        # Widen the search until something is found, as any city within the radius beats all those outside it
+        radius_km = min(self.bucket_degrees * 111, limit)
+        while True:
+            found = self.within(latitude, longitude, radius_km)
+            if found:
+                return found[0][1]
+            if radius_km >= limit:
+                return None
+            radius_km = min(radius_km * 2, limit)
+
+
+if __name__ == "__main__":
+    # Compare query latency with the map window scans the tuning loop used to rely on
+    import random
+    import time
+    import database
+    from positional_encoders import ENCODER_RESOLUTION
+
+    def window(latitude, longitude, fuzziness):
+        # The same cells as main.Look_Around, in any order
+        return [
+            [(latitude + x) % ENCODER_RESOLUTION, (longitude + y) % ENCODER_RESOLUTION]
+            for y in range(-fuzziness, fuzziness + 1)
+            for x in range(-fuzziness, fuzziness + 1)
+        ]
+
+    def window_scan_nearest(latitude, longitude):
+        indices = set(database.index_map.read_window(window(latitude, longitude, 5)))
+        indices.discard(database.EMPTY)
+        best = None
+        for index in indices:
+            city_lat, city_lon = database.catalog.cell(index)
+            lat_diff = min(
+                abs(latitude - city_lat), ENCODER_RESOLUTION - abs(latitude - city_lat)
+            )
+            lon_diff = min(
+                abs(longitude - city_lon),
+                ENCODER_RESOLUTION - abs(longitude - city_lon),
+            )
+            distance_sq = lat_diff**2 + lon_diff**2
+            if best is None or distance_sq < best[0]:
+                best = (distance_sq, index)
+        return best
+
+    def window_scan_nearby(latitude, longitude):
+        indices = set(database.index_map.read_window(window(latitude, longitude, 7)))
+        indices.discard(database.EMPTY)
+        return sorted(database.catalog.location(index) for index in indices)
+
+    database.Load_Map()
+    catalog = database.catalog
+    index = Spatial_Index(catalog.latitudes, catalog.longitudes)
+
+    # Query points scattered around the cities, as the reticule would be when a city is found
+    random.seed(1)
+    points = []
+    for _ in range(2000):
+        city = random.randrange(len(catalog))
+        points.append(
+            (
+                catalog.latitudes[city] + random.uniform(-2, 2),
+                ((catalog.longitudes[city] + random.uniform(-2, 2) + 180) % 360) - 180,
+            )
+        )
+    cells = [
+        (database.Degrees_To_Cell(lat), database.Degrees_To_Cell(lon))
+        for lat, lon in points
+    ]
+
+    def measure(label, function, arguments):
+        start = time.perf_counter()
+        for argument in arguments:
+            function(*argument)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<34}{elapsed / len(arguments) * 1e6:8.1f} us/query")
+
+    measure("window scan, fuzziness 5 + flat", window_scan_nearest, cells)
+    measure("Spatial_Index.nearest", index.nearest, points)
+    measure("window scan, fuzziness 7", window_scan_nearby, cells)
+    measure("Spatial_Index.within 400 km", index.within, [p + (400,) for p in points])
+
+    # Check against a brute force search
+    for latitude, longitude in points[:200]:
+        expected = min(
+            range(len(catalog)),
+            key=lambda i: Haversine_Km(
+                latitude, longitude, catalog.latitudes[i], catalog.longitudes[i]
+            ),
+        )
+        found = index.nearest(latitude, longitude)
+        assert Haversine_Km(
+            latitude, longitude, catalog.latitudes[found], catalog.longitudes[found]
+        ) == Haversine_Km(
+            latitude,
+            longitude,
+            catalog.latitudes[expected],
+            catalog.longitudes[expected],
+        )
+    print("nearest agrees with a brute force search")
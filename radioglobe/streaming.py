@@ -1,57 +1,635 @@
 # Thanks to Peter Milne!
 import subprocess
 import logging
+import threading
+import time
+from collections import OrderedDict
+import playlist
+import metrics
+
+try:
+    import vlc
+except (ImportError, OSError):
+    # python-vlc is missing or libvlc could not be loaded, only cvlc can be used
+    vlc = None
+
+# A long-lived libVLC player that switches stations in place
+BACKEND_LIBVLC = "libvlc"
+# A new cvlc process for every station
+BACKEND_CVLC = "cvlc"
+
+# Seconds a stopped cvlc process gets to exit after SIGTERM, and then after SIGKILL
+TERMINATE_TIMEOUT = 5
+KILL_TIMEOUT = 5
+REAP_POLL_SEC = 0.1
+
+# At most this many stations are opened ahead on muted players.  Each one holds a connection and about
+# PREFETCH_CACHING_MS of the stream in libVLC's buffers.
+PREFETCH_LIMIT = 2
+PREFETCH_CACHING_MS = 1000
+
+# Stations that were playing when stopped are kept connected on muted players for up to RECENT_MAX_AGE_SEC,
+# so going back to one is instant.  The number kept is limited by recent_memory_mb, counting each player
+# as RECENT_PLAYER_MB: libVLC's demuxer, decoder and audio buffers, plus PREFETCH_CACHING_MS of stream.
+RECENT_PLAYER_MB = 4
+RECENT_MAX_AGE_SEC = 300
+recent_memory_mb = 16
+
+# Up to this many stopped players are kept to be reused, as creating one costs more than switching its media
+SPARE_PLAYER_LIMIT = 2
+
+# A stream that hasn't started playing this long after play(), or has stopped advancing this long, has failed
+START_TIMEOUT_SEC = 10
+STALL_TIMEOUT_SEC = 5
+
+STATE_STARTING = "starting"
+STATE_PLAYING = "playing"
+STATE_FAILED = "failed"
+STATE_STOPPED = "stopped"
+
+# A pause in the playback clock this long counts as a buffer underrun
+UNDERRUN_SEC = 1
+# How often the stream bitrate is read from libVLC's statistics
+BITRATE_SAMPLE_SEC = 10
+
+# Output volume, 0 to 100, applied to every player
+volume_level = 100
+
+PROCESS = 0
+DEADLINE = 1
+KILLED = 2
+
+
+class VLC_Engine:
+    """One libVLC instance and media player, kept for the life of the program.
+
+    Stations next to the one playing can be opened on extra, muted players, ready to be swapped in.  A
+    player that is let go is stopped in the background and kept as a spare, so a new one is rarely created.
+    """
+
+    def __init__(self, audio):
+        self.instance = vlc.Instance(["--no-video", f"--aout={audio}"])
+        # Stopped players ready to be reused, filled from the threads that stop them
+        self.spares = []
+        self.spares_lock = threading.Lock()
+        self.player = self._spare_player()
+        self.owner = None
+        self.station_url = None
+        # Station URL -> muted player, oldest first
+        self.prefetched = OrderedDict()
+        # Station URL -> [muted player, time.monotonic() it was parked], oldest first
+        self.recent = OrderedDict()
+
+    def _spare_player(self):
+        with self.spares_lock:
+            if self.spares:
+                return self.spares.pop()
+        player = self.instance.media_player_new()
+        events = player.event_manager()
+        for event_type in (
+            vlc.EventType.MediaPlayerOpening,
+            vlc.EventType.MediaPlayerBuffering,
+            vlc.EventType.MediaPlayerTimeChanged,
+        ):
+            events.event_attach(event_type, self._forward, player)
+        events.event_attach(vlc.EventType.MediaPlayerPlaying, self._on_playing, player)
+        return player
+
+    def _on_playing(self, event, player):
+        # Called on a libVLC thread.  libVLC can reset the volume and mute when the audio output starts, so
+        # they are set again once playing.  Every player but the audible one is muted.
+        if player is self.player:
+            player.audio_set_volume(volume_level)
+        else:
+            player.audio_set_mute(True)
+
+    def recycle(self, player):
+        # Stopping a network stream can block for the whole teardown, so the player is stopped in the
+        # background and then kept as a spare, or released if there are enough
+        def stop():
+            player.stop()
+            with self.spares_lock:
+                if len(self.spares) < SPARE_PLAYER_LIMIT:
+                    self.spares.append(player)
+                    return
+            player.release()
+
+        threading.Thread(target=stop, name="Recycle_Player", daemon=True).start()
+
+    def _forward(self, event, player):
+        # Called on a libVLC thread.  Only events from the audible player go to the streamer that owns it.
+        owner = self.owner
+        if player is self.player and hasattr(owner, "player_event"):
+            owner.player_event(event)
+
+    def _open(self, player, url, options=()):
+        media = self.instance.media_new(url, *options)
+        player.set_media(media)
+        media.release()
+        player.play()
+
+    def play(self, owner, url, station_url=None):
+        # Returns True if a prefetched or recently played player was swapped in
+        player = None
+        if station_url:
+            player = self.prefetched.pop(station_url, None)
+            if player is None and station_url in self.recent:
+                player = self.recent.pop(station_url)[0]
+        self.owner = owner
+        self.station_url = station_url
+        if player is not None:
+            # Already connected and buffered, so it only has to be heard
+            self.recycle(self.player)
+            self.player = player
+            player.audio_set_mute(False)
+        else:
+            # Switching media on the existing player avoids process startup, plugin loading and audio output init
+            self.player.audio_set_mute(False)
+            self._open(self.player, url)
+        self.player.audio_set_volume(volume_level)
+        return player is not None
+
+    def stop(self, owner, keep=False):
+        # Only the streamer that started the current media may stop it.  With keep, the player is muted and
+        # parked with the recent stations instead, if there is room for any.
+        if self.owner is owner:
+            if keep and self.station_url and recent_memory_mb >= RECENT_PLAYER_MB:
+                self.player.audio_set_mute(True)
+                self.recent.pop(self.station_url, None)
+                self.recent[self.station_url] = [self.player, time.monotonic()]
+                self.player = self._spare_player()
+                self.trim_recent()
+            else:
+                # A spare takes the player's place while it is stopped in the background
+                self.recycle(self.player)
+                self.player = self._spare_player()
+            self.owner = None
+            self.station_url = None
+
+    def trim_recent(self):
+        # Drop the oldest recent stations beyond the memory limit, and any parked for too long
+        limit = int(recent_memory_mb // RECENT_PLAYER_MB)
+        now = time.monotonic()
+        for url in list(self.recent):
+            player, parked = self.recent[url]
+            if len(self.recent) > limit or now - parked > RECENT_MAX_AGE_SEC:
+                del self.recent[url]
+                self.recycle(player)
+
+    def prefetch(self, station_urls):
+        """Keep muted players open on station_urls, most wanted first, and drop all others"""
+        wanted = [
+            url
+            for url in station_urls
+            if url != self.station_url and url not in self.recent
+        ]
+        wanted = list(dict.fromkeys(wanted))[:PREFETCH_LIMIT]
+        for url in list(self.prefetched):
+            if url not in wanted:
+                self.recycle(self.prefetched.pop(url))
+
+        for url in wanted:
+            if url in self.prefetched:
+                continue
+            player = self._spare_player()
+            player.audio_set_mute(True)
+            self.prefetched[url] = player
+            self._open(
+                player,
+                playlist.Lookup(url),
+                [f":network-caching={PREFETCH_CACHING_MS}"],
+            )
+            logging.info("Prefetching station: %s", url)
+
+
+engines = {}
+
+
+def Get_Engine(audio):
+    if audio not in engines:
+        engines[audio] = VLC_Engine(audio)
+        logging.info("libVLC engine created for audio output %s", audio)
+    return engines[audio]
+
+
+def Set_Volume(audio, volume):
+    """Set the output volume, 0 to 100.  libVLC applies it at once, cvlc from the next station it starts."""
+    global volume_level
+    volume_level = min(max(int(volume), 0), 100)
+    if audio in engines:
+        try:
+            engines[audio].player.audio_set_volume(volume_level)
+        except Exception as e:
+            logging.info("Error setting volume: %s", e)
+
+
+def Set_Recent_Memory(megabytes):
+    """Set how much memory players kept for recently played stations may use, 0 to keep none"""
+    global recent_memory_mb
+    recent_memory_mb = megabytes
+    for engine in engines.values():
+        engine.trim_recent()
+
+
+def Expire_Recent(audio):
+    # Called regularly, so players parked too long stop using the network
+    if audio in engines:
+        engines[audio].trim_recent()
+
+
+def Prefetch(audio, station_urls):
+    """Open station_urls muted in the background, so that playing one of them next is instant"""
+    if vlc is None:
+        return
+    try:
+        Get_Engine(audio).prefetch(station_urls)
+    except Exception as e:
+        logging.info("Error prefetching stations: %s", e)
+
+
+def Drop_Prefetched(audio):
+    if audio in engines:
+        try:
+            engines[audio].prefetch([])
+        except Exception as e:
+            logging.info("Error dropping prefetched stations: %s", e)
+
+
+class Reaper(threading.Thread):
+    """Stops cvlc processes in the background, escalating from SIGTERM to SIGKILL"""
+
+    def __init__(self, threadID, name):
+        threading.Thread.__init__(self, daemon=True)
+        self.threadID = threadID
+        self.name = name
+
+        self.condition = threading.Condition()
+        self.processes = []
+
+        # Players that had already exited before being stopped, and so sat as zombies until reaped
+        self.zombies = 0
+        # Players that exited after SIGTERM, and those that needed SIGKILL
+        self.terminated = 0
+        self.killed = 0
+        # Players still running after SIGKILL, which are given up on
+        self.orphaned = 0
+
+    def reap(self, process):
+        # Returns at once, the process is terminated and waited for on the reaper thread
+        with self.condition:
+            if process.poll() is not None:
+                self.zombies += 1
+                logging.info(
+                    "Streamer process %s had already exited with code %s",
+                    process.pid,
+                    process.returncode,
+                )
+                return
+            try:
+                logging.info("Terminating Streamer PID %s", process.pid)
+                process.terminate()
+            except Exception as e:
+                logging.info("Error terminating Streamer: %s", e)
+            self.processes.append(
+                [process, time.monotonic() + TERMINATE_TIMEOUT, False]
+            )
+            self.condition.notify()
+
+    def pending(self):
+        with self.condition:
+            return len(self.processes)
+
+    def counts(self):
+        with self.condition:
+            return {
+                "pending": len(self.processes),
+                "zombies": self.zombies,
+                "terminated": self.terminated,
+                "killed": self.killed,
+                "orphaned": self.orphaned,
+            }
+
+    def run(self):
+        with self.condition:
+            while True:
+                while not self.processes:
+                    self.condition.wait()
+
+                now = time.monotonic()
+                remaining = []
+                for entry in self.processes:
+                    process = entry[PROCESS]
+                    if process.poll() is not None:
+                        if entry[KILLED]:
+                            logging.info("Streamer PID %s killed", process.pid)
+                        else:
+                            self.terminated += 1
+                            logging.info(
+                                "Streamer PID %s terminated cleanly", process.pid
+                            )
+                    elif now < entry[DEADLINE]:
+                        remaining.append(entry)
+                    elif not entry[KILLED]:
+                        logging.info(
+                            "Streamer PID %s did not terminate, killing", process.pid
+                        )
+                        try:
+                            process.kill()
+                        except Exception as e:
+                            logging.info("Error killing Streamer: %s", e)
+                        self.killed += 1
+                        entry[DEADLINE] = now + KILL_TIMEOUT
+                        entry[KILLED] = True
+                        remaining.append(entry)
+                    else:
+                        self.orphaned += 1
+                        logging.warning(
+                            "Streamer PID %s survived SIGKILL, giving up on it",
+                            process.pid,
+                        )
+                self.processes = remaining
+
+                if self.processes:
+                    self.condition.wait(REAP_POLL_SEC)
+
+
+reaper = None
+reaper_lock = threading.Lock()
+
+
+def Get_Reaper():
+    global reaper
+    with reaper_lock:
+        if reaper is None:
+            reaper = Reaper(1, "Reaper")
+            reaper.start()
+    return reaper
 
 
 class Streamer:
-    """A streaming audio player using VLC's command line"""
+    """A streaming audio player using libVLC, or VLC's command line"""
 
-    def __init__(self, audio, url):
+    def __init__(self, audio, url, backend=BACKEND_LIBVLC, requested_at=None):
+        # requested_at is the time.monotonic() of whatever asked for the station, for timing the tune
         logging.info("Starting Streamer: %s, %s", audio, url)
         self.audio = audio
         self.url = url
+        # The URL handed to the player, after playlist resolution
+        self.stream_url = None
         self.process = None
+        self.engine = None
+        self.stopped = False
+        self.started = None
+        # When state() first found the stream playing
+        self.playing_since = None
+        # libVLC's playback clock, and when it last moved
+        self.last_time = 0
+        self.last_progress = None
+        self.underrun = False
+        self.last_bitrate_sample = 0
+        self.tune = metrics.Tune(url, requested_at)
+        if backend == BACKEND_LIBVLC and vlc is None:
+            logging.warning("libVLC is not available, falling back to cvlc")
+            backend = BACKEND_CVLC
+        self.backend = backend
 
     def play(self):
+        self.tune.mark(metrics.PLAY)
+        # Go straight to the stream if its playlist has been resolved before
+        url = playlist.Lookup(self.url)
+        self.stream_url = url
+        self.tune.mark(metrics.RESOLVED)
+        if url != self.url:
+            self.tune.cache_hit = True
+            logging.info("Using resolved stream URL: %s", url)
+        self.started = time.monotonic()
+
+        if self.backend == BACKEND_LIBVLC:
+            try:
+                self.engine = Get_Engine(self.audio)
+                if self.engine.play(self, url, self.url):
+                    self.tune.mark(metrics.FIRST_AUDIO)
+                    logging.info("Streamer resumed a connected station: %s", url)
+                else:
+                    logging.info("Streamer playing in libVLC: %s", url)
+            except Exception as e:
+                logging.info("Error playing in libVLC: %s", e)
+                self.engine = None
+            return
+
         try:
-            logging.info("Launching VLC for URL: %s", self.url)
+            logging.info("Launching VLC for URL: %s", url)
+            # Exit rather than idle when the stream fails or ends, so the failure can be seen
             self.process = subprocess.Popen(
-                ["cvlc", "--intf", "dummy", "--aout", self.audio, self.url],
+                [
+                    "cvlc",
+                    "--intf",
+                    "dummy",
+                    "--play-and-exit",
+                    "--gain",
+                    f"{volume_level / 100:.2f}",
+                    "--aout",
+                    self.audio,
+                    url,
+                ],
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
             )
+            # cvlc can't be seen past this point, so the tune is only timed to here
+            self.tune.mark(metrics.OPENING)
             logging.info("Streamer started with PID %s", self.process.pid)
         except Exception as e:
             logging.info("Error launching Streamer: %s", e)
             self.process = None
 
+    def state(self):
+        """Return STATE_STARTING, STATE_PLAYING, STATE_FAILED or STATE_STOPPED.
+
+        With libVLC a stream has failed when the player errors or ends, takes longer than START_TIMEOUT_SEC
+        to start, or its clock stops for STALL_TIMEOUT_SEC.  cvlc can only be seen to fail when it exits.
+        """
+        if self.stopped:
+            return STATE_STOPPED
+        if self.started is None:
+            return STATE_STARTING
+        now = time.monotonic()
+
+        if self.backend == BACKEND_CVLC:
+            if self.process is None or self.process.poll() is not None:
+                return STATE_FAILED
+            return self._playing(now)
+
+        if self.engine is None or self.engine.owner is not self:
+            return STATE_FAILED
+        player = self.engine.player
+        if player.get_state() in (
+            vlc.State.Error,
+            vlc.State.Ended,
+            vlc.State.Stopped,
+        ):
+            return STATE_FAILED
+        playback_time = player.get_time()
+        if playback_time > self.last_time:
+            self.last_time = playback_time
+            self.last_progress = now
+            self.underrun = False
+        if self.last_progress is None:
+            if now - self.started > START_TIMEOUT_SEC:
+                return STATE_FAILED
+            return STATE_STARTING
+        if now - self.last_progress > STALL_TIMEOUT_SEC:
+            return STATE_FAILED
+        return self._playing(now)
+
+    def _playing(self, now):
+        if self.playing_since is None:
+            self.playing_since = now
+        return STATE_PLAYING
+
+    def played_sec(self):
+        """Seconds the stream has been playing, 0 until state() has found it playing"""
+        if self.playing_since is None:
+            return 0
+        return time.monotonic() - self.playing_since
+
+    def sample_bitrate(self, player):
+        media = player.get_media()
+        stats = vlc.MediaStats()
+        if media is not None and media.get_stats(stats) and stats.input_bitrate > 0:
+            # libVLC gives bytes per microsecond
+            metrics.Get_Station_Metrics().record_bitrate(
+                self.url, stats.input_bitrate * 8000
+            )
+
+    def record_metrics(self):
+        """Record the tune once it has reached first audio, then any underruns and the bitrate.  Called from
+        the main loop straight after state(), which brings the playback clock up to date.  Kept apart from
+        state() so that asking the state records nothing.
+        """
+        if self.tune.heard():
+            self.tune.finish()
+        if self.stopped or self.engine is None or self.engine.owner is not self:
+            return
+        if self.last_progress is None:
+            return
+        now = time.monotonic()
+        if now - self.last_progress > UNDERRUN_SEC and not self.underrun:
+            self.underrun = True
+            metrics.Get_Station_Metrics().record_underrun(self.url)
+            logging.info("Buffer underrun on %s", self.url)
+        if now - self.last_bitrate_sample > BITRATE_SAMPLE_SEC:
+            self.last_bitrate_sample = now
+            self.sample_bitrate(self.engine.player)
+
+    def player_event(self, event):
+        # Called on a libVLC thread
+        if event.type == vlc.EventType.MediaPlayerOpening:
+            self.tune.mark(metrics.OPENING)
+        elif event.type == vlc.EventType.MediaPlayerBuffering:
+            self.tune.mark(metrics.BUFFERING)
+        elif event.type == vlc.EventType.MediaPlayerTimeChanged:
+            if event.u.new_time > 0:
+                self.tune.mark(metrics.FIRST_AUDIO)
+
     def stop(self):
-        """Stop the VLC process."""
+        """Stop the VLC process in the background, or the libVLC player if this streamer is still the one playing."""
+        # A stream that was playing well is worth keeping connected in case it is wanted again
+        keep = self.engine is not None and self.state() == STATE_PLAYING
+        self.stopped = True
+        # Record the tune, or how far it got if it never reached first audio
+        self.tune.finish()
+        if self.engine is not None:
+            try:
+                self.engine.stop(self, keep)
+                logging.info("Streamer stopped in libVLC")
+            except Exception as e:
+                logging.info("Error stopping Streamer: %s", e)
+            finally:
+                self.engine = None
+            return
+
         if self.process is None:
             logging.info("No Streamer process to stop")
             return
 
-        if self.process.poll() is not None:
-            logging.info(
-                "Streamer process already exited with code %s", self.process.returncode
-            )
-            self.process = None
-            return
+        # Never wait on the caller's thread, the reaper terminates and waits for the process
+        Get_Reaper().reap(self.process)
+        self.process = None
+
 
+if __name__ == "__main__":
+    # Measure switch-to-audio latency for both backends, and for prefetched stations:
+    # python streaming.py <url> [<url> ...]
+    import sys
+
+    logging.basicConfig(level=logging.WARNING)
+    urls = sys.argv[1:]
+    TIMEOUT = 15
+
+    def libvlc_latency(url, station_url=None):
+        # Time from asking for the station until libVLC's playback clock starts moving
+        engine = Get_Engine("pulse")
+        start = time.monotonic()
+        engine.play("measure", url, station_url)
+        while time.monotonic() - start < TIMEOUT:
+            if engine.player.get_state() == vlc.State.Error:
+                return None
+            if engine.player.get_time() > 0:
+                return time.monotonic() - start
+            time.sleep(0.01)
+        return None
+
+    def cvlc_latency(url):
+        # Time from launching cvlc until it reports its input has buffered and started to play
+        start = time.monotonic()
+        process = subprocess.Popen(
+            ["cvlc", "--intf", "dummy", "--aout", "pulse", "-vv", url],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="replace",
+        )
         try:
-            logging.info("Terminating Streamer PID %s", self.process.pid)
-            self.process.terminate()  # send SIGTERM first
-            try:
-                self.process.wait(timeout=5)
-                logging.info("Streamer PID %s terminated cleanly", self.process.pid)
-            except subprocess.TimeoutExpired:
-                logging.info(
-                    "Streamer PID %s did not terminate, killing", self.process.pid
-                )
-                self.process.kill()  # send SIGKILL if needed
-                self.process.wait()
-                logging.info("Streamer PID %s killed", self.process.pid)
-        except Exception as e:
-            logging.info("Error stopping Streamer: %s", e)
+            for line in process.stderr:
+                if "Stream buffering done" in line:
+                    return time.monotonic() - start
+                if time.monotonic() - start > TIMEOUT:
+                    break
+            return None
         finally:
-            self.process = None
+            process.terminate()
+            process.wait()
+
+    def prefetched_latency(url):
+        # Open the station muted, give it time to buffer, then time the switch to it
+        engine = Get_Engine("pulse")
+        engine.prefetch([url])
+        deadline = time.monotonic() + TIMEOUT
+        while engine.prefetched[url].get_time() <= 0:
+            if time.monotonic() > deadline:
+                engine.prefetch([])
+                return None
+            time.sleep(0.01)
+        return libvlc_latency(url, url)
+
+    backends = [(BACKEND_CVLC, cvlc_latency)]
+    if vlc is not None:
+        backends[:0] = [
+            (BACKEND_LIBVLC, libvlc_latency),
+            ("prefetch", prefetched_latency),
+        ]
+
+    for backend, measure in backends:
+        results = []
+        for url in urls:
+            latency = measure(url)
+            results.append(latency)
+            shown = "failed" if latency is None else f"{latency * 1000:.0f} ms"
+            print(f"{backend:<10}{shown:>10}  {url}")
+        played = sorted(latency for latency in results if latency is not None)
+        if played:
+            print(
+                f"{backend:<10}median {played[len(played) // 2] * 1000:.0f} ms over {len(played)} stations"
+            )
+        if backend != BACKEND_CVLC:
+            Get_Engine("pulse").stop("measure")
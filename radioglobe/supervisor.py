@@ -0,0 +1,139 @@
+#! /usr/bin/python3
+import json
+import logging
+import os
+import time
+from collections import deque
+import metrics
+
+RECOVERY_FILE = "data/recovery.json"
+
+# A failed URL isn't tried again automatically for BACKOFF_START_SEC, doubling with each further failure
+BACKOFF_START_SEC = 10
+BACKOFF_MAX_SEC = 600
+# A URL's backoff is only reset once it has played this long, so one that dies soon after starting goes on
+# backing off.  cvlc counts as playing as soon as it is running.
+HEALTHY_SEC = 30
+
+# How many of the latest times to recover are kept
+RECOVERY_HISTORY = 50
+
+FAILURES = 0
+RETRY_AFTER = 1
+
+
+class Supervisor:
+    """Decides which station to fail over to when a stream dies, and measures how long recovery takes.
+
+    The main loop reports each stream as failed or playing.  URLs that fail back off exponentially, and
+    the time from a failure to the next stream playing is recorded.
+    """
+
+    def __init__(self, path: str = RECOVERY_FILE):
+        self.path = path
+        # URL -> [consecutive failures, monotonic time it may be retried]
+        self.backoff = {}
+        self.failed_since = None
+
+        self.failures = 0
+        self.recoveries = 0
+        self.recover_ms = deque(maxlen=RECOVERY_HISTORY)
+        self.max_recover_ms = 0
+
+    def failed(self, url: str):
+        now = time.monotonic()
+        entry = self.backoff.setdefault(url, [0, now])
+        entry[FAILURES] += 1
+        delay = min(BACKOFF_START_SEC * 2 ** (entry[FAILURES] - 1), BACKOFF_MAX_SEC)
+        entry[RETRY_AFTER] = now + delay
+        self.failures += 1
+        metrics.Get_Station_Metrics().record_failure(url)
+        if self.failed_since is None:
+            self.failed_since = now
+        logging.warning(
+            f"Stream failed ({entry[FAILURES]} in a row), not retrying for {delay} s: {url}"
+        )
+
+    def playing(self, url: str, played_sec: float):
+        # played_sec is how long the stream has been playing without a break
+        if played_sec >= HEALTHY_SEC and url in self.backoff:
+            del self.backoff[url]
+        if self.failed_since is not None:
+            elapsed_ms = round((time.monotonic() - self.failed_since) * 1000)
+            self.failed_since = None
+            self.recoveries += 1
+            self.recover_ms.append(elapsed_ms)
+            self.max_recover_ms = max(self.max_recover_ms, elapsed_ms)
+            logging.info(f"Stream recovered in {elapsed_ms} ms: {url}")
+            self.save()
+
+    def recovering(self):
+        return self.failed_since is not None
+
+    def cancel(self):
+        # Stop counting towards a recovery, as the user has moved on
+        self.failed_since = None
+
+    def next_index(self, urls: list, current: int):
+        """Return the index of the next URL after current that isn't backing off, or None"""
+        now = time.monotonic()
+        for offset in range(1, len(urls) + 1):
+            index = (current + offset) % len(urls)
+            entry = self.backoff.get(urls[index])
+            if entry is None or entry[RETRY_AFTER] <= now:
+                return index
+        return None
+
+    def counters(self):
+        recover_ms = sorted(self.recover_ms)
+        return {
+            "failures": self.failures,
+            "recoveries": self.recoveries,
+            "backing_off": len(self.backoff),
+            "last_recover_ms": self.recover_ms[-1] if self.recover_ms else None,
+            "median_recover_ms": (
+                recover_ms[len(recover_ms) // 2] if recover_ms else None
+            ),
+            "max_recover_ms": self.max_recover_ms,
+        }
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", "w") as recovery_file:
+                recovery_file.write(json.dumps(self.counters()))
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.error(f"Failed to save recovery counters: {e}")
+
+
+if __name__ == "__main__":
+    # Walk through a failover: two of three stations fail, then one comes back
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        supervisor = Supervisor(os.path.join(directory, "recovery.json"))
+        urls = ["a", "b", "c"]
+
+        supervisor.failed("a")
+        assert supervisor.next_index(urls, 0) == 1
+        supervisor.failed("b")
+        assert supervisor.next_index(urls, 1) == 2
+        supervisor.playing("c", 0)
+        assert not supervisor.recovering()
+        assert supervisor.counters()["recoveries"] == 1
+
+        # Backoff doubles with each failure in a row, and resets once the URL has played for HEALTHY_SEC
+        supervisor.failed("c")
+        supervisor.failed("c")
+        assert supervisor.backoff["c"][FAILURES] == 2
+        assert supervisor.next_index(urls, 2) is None
+        supervisor.backoff["a"][RETRY_AFTER] = 0
+        assert supervisor.next_index(urls, 2) == 0
+        supervisor.playing("c", 1)
+        assert supervisor.backoff["c"][FAILURES] == 2
+        supervisor.playing("c", HEALTHY_SEC)
+        assert "c" not in supervisor.backoff
+
+        with open(supervisor.path, "r") as recovery_file:
+            print(json.load(recovery_file))
@@ -2,20 +2,30 @@ import time
 from button import Button_Manager
 from dial import Dial
 import logging
+from events import JOG, MODE_TOGGLE, BUTTON
+from runtime import Start_Device
 
 SHUTDOWN_HOLD_TIME = 3
 CALIBRATE_HOLD_TIME = 5
 
 
 class UI_Manager:
-    def __init__(self):
+    def __init__(self, events=None, device_loop=None, scheduler=None):
+        # With an event queue the dial and buttons post to it, and translate() turns what they post into
+        # UI events.  Without one, update() polls them.  With a device loop they run on it, not on threads.
+        # With a scheduler, shutdown and calibrate happen as soon as their buttons have been held long
+        # enough, rather than when they are let go.
         try:
             # self.button_manager = Button_Manager([("Top", 5), ("Mid", 6), ("Low", 12), ("Shutdown", 26)])
             self.button_manager = Button_Manager(
-                [("Top", 5), ("Mid", 6), ("Low", 12), ("Shutdown", 27)]
+                [("Top", 5), ("Mid", 6), ("Low", 12), ("Shutdown", 27)],
+                events,
+                device_loop,
+                {"Shutdown": SHUTDOWN_HOLD_TIME, "Mid": CALIBRATE_HOLD_TIME},
+                scheduler,
             )
-            self.dial = Dial(10, "Jog", button_pin=27)
-            self.dial.start()
+            self.dial = Dial(10, "Jog", button_pin=27, events=events)
+            Start_Device(self.dial, device_loop)
             self.last_mode = self.dial.get_mode()
             logging.info("UI_Manager initialized")
         except Exception as e:
@@ -42,30 +52,46 @@ class UI_Manager:
             button_events = []
             self.button_manager.update(button_events)
             for event in button_events:
-                if event[0] == "Shutdown" and event[1] > SHUTDOWN_HOLD_TIME:
-                    # ui_events = [["Shutdown", 0]]
-                    ui_events.append(["Shutdown", 0])
-                    self.button_manager.clear("Shutdown")
-                    logging.debug("Shutdown event triggered")
+                if self.button_event(event, ui_events):
                     break
-                elif event[0] == "Mid":
-                    if event[1] > CALIBRATE_HOLD_TIME:
-                        ui_events.append(["Calibrate", 0])
-                        self.button_manager.clear("Mid")
-                        logging.debug("Calibrate event triggered")
-                    else:
-                        ui_events.append(["Confirm", 0])
-                        logging.debug("Confirm event triggered")
-                elif event[0] == "Top":
-                    ui_events.append(["Volume", 1])
-                    logging.debug("Volume up event")
-                elif event[0] == "Low":
-                    ui_events.append(["Volume", -1])
-                    logging.debug("Volume down event")
             receiving_queue.extend(ui_events)
         except Exception as e:
             logging.error(f"UI update failed: {e}")
 
+    def translate(self, event: list, receiving_queue: list):
+        # Turn an event posted by the dial or a button into UI events
+        if event[0] == JOG:
+            receiving_queue.append(["Jog", event[1]])
+        elif event[0] == MODE_TOGGLE:
+            self.last_mode = event[1]
+            receiving_queue.append(["Mode_Toggle", 0])
+        elif event[0] == BUTTON:
+            self.button_event(event[1], receiving_queue)
+
+    def button_event(self, event: list, ui_events: list):
+        # event is [button name, seconds held].  Returns True for a shutdown, which overrides the rest.
+        if event[0] == "Shutdown" and event[1] >= SHUTDOWN_HOLD_TIME:
+            # ui_events = [["Shutdown", 0]]
+            ui_events.append(["Shutdown", 0])
+            self.button_manager.clear("Shutdown")
+            logging.debug("Shutdown event triggered")
+            return True
+        elif event[0] == "Mid":
+            if event[1] >= CALIBRATE_HOLD_TIME:
+                ui_events.append(["Calibrate", 0])
+                self.button_manager.clear("Mid")
+                logging.debug("Calibrate event triggered")
+            else:
+                ui_events.append(["Confirm", 0])
+                logging.debug("Confirm event triggered")
+        elif event[0] == "Top":
+            ui_events.append(["Volume", 1])
+            logging.debug("Volume up event")
+        elif event[0] == "Low":
+            ui_events.append(["Volume", -1])
+            logging.debug("Volume down event")
+        return False
+
 
 if __name__ == "__main__":
     ui_manager = UI_Manager()
@@ -0,0 +1,418 @@
+#!/usr/bin/python
+
+"""
+Probe station health
+
+Checks every station URL in a stations json file and records what was found in a health json file, which
+RadioGlobe uses to skip dead stations.
+
+1. Playlists and redirects are followed to the stream itself
+
+2. The HTTP status, content type, time to first byte of the stream, codec and bitrate are recorded
+
+3. URLs are probed concurrently, with a limit on connections to any one host, counting the hosts that
+   playlists lead to as well as those in stations.json
+
+Usage: probe_stations [--workers N] [--per-host N] [--timeout SEC] [<stations_json> [<health_json>]]
+eg: probe_stations 'stations.json' 'health.json'
+
+    probe_stations --self-test    checks the prober against a local stand-in server
+
+Copy the health file to /opt/radioglobe next to stations.json for RadioGlobe to use it.
+"""
+
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "radioglobe")
+)
+import playlist
+
+WORKERS = 32
+PER_HOST = 2
+TIMEOUT_SEC = 10
+
+CODECS = {
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/aac": "aac",
+    "audio/aacp": "aac+",
+    "audio/x-aac": "aac",
+    "audio/ogg": "ogg",
+    "application/ogg": "ogg",
+    "audio/opus": "opus",
+    "audio/flac": "flac",
+    "audio/x-flac": "flac",
+    "application/vnd.apple.mpegurl": "hls",
+    "application/x-mpegurl": "hls",
+    "audio/x-mpegurl": "hls",
+    "audio/mpegurl": "hls",
+}
+
+
+def Sniff_Codec(data: bytes):
+    # Used when the server doesn't say, or calls the stream application/octet-stream
+    if data.startswith(b"ID3"):
+        return "mp3"
+    if data.startswith(b"OggS"):
+        return "ogg"
+    if data.startswith(b"fLaC"):
+        return "flac"
+    if data.startswith(b"#EXTM3U"):
+        return "hls"
+    if len(data) >= 2 and data[0] == 0xFF and data[1] & 0xF0 == 0xF0:
+        # ADTS AAC frames have a layer of 0, MPEG audio frames don't
+        return "aac" if data[1] & 0x06 == 0 else "mp3"
+    return None
+
+
+def Host(url: str):
+    return urlsplit(url).netloc.lower()
+
+
+class Host_Limits:
+    """Counts the connections open to each host, keeping them to a limit"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.open = Counter()
+        self.condition = threading.Condition()
+
+    def try_acquire(self, host: str):
+        with self.condition:
+            if self.open[host] >= self.limit:
+                return False
+            self.open[host] += 1
+            return True
+
+    def acquire(self, host: str):
+        with self.condition:
+            while self.open[host] >= self.limit:
+                self.condition.wait()
+            self.open[host] += 1
+
+    def release(self, host: str):
+        with self.condition:
+            self.open[host] -= 1
+            if not self.open[host]:
+                del self.open[host]
+            self.condition.notify_all()
+
+
+def Probe(url: str, timeout: float = TIMEOUT_SEC, before_request: callable = None):
+    """Return the health of a station URL as a dict, without raising.
+
+    The stream is read from the response that resolving it opened, so it is only fetched once.
+    before_request, if given, is called with each URL before it is requested, playlists included.
+    """
+    health = {
+        "alive": False,
+        "status": None,
+        "content_type": None,
+        "ttfb_ms": None,
+        "codec": None,
+        "bitrate_kbps": None,
+        "stream_url": None,
+        "error": None,
+        "checked": int(time.time()),
+    }
+    # Time to first byte is timed from the request for the stream itself, not from the playlists
+    start = None
+
+    def requesting(request_url):
+        nonlocal start
+        if before_request is not None:
+            before_request(request_url)
+        health["stream_url"] = request_url
+        start = time.perf_counter()
+
+    try:
+        try:
+            stream_url, response, body = playlist.Open_Stream(
+                url, timeout=timeout, before_request=requesting
+            )
+            with response:
+                health["stream_url"] = stream_url
+                first_bytes = body[:4] or response.read(4)
+                health["ttfb_ms"] = round((time.perf_counter() - start) * 1000)
+                health["status"] = response.status
+                content_type = response.headers.get("Content-Type", "")
+                health["content_type"] = content_type
+                content_type = content_type.split(";")[0].strip().lower()
+                health["codec"] = CODECS.get(content_type) or Sniff_Codec(first_bytes)
+                bitrate = response.headers.get("icy-br", "").split(",")[0].strip()
+                if bitrate.isdigit():
+                    health["bitrate_kbps"] = int(bitrate)
+                health["alive"] = bool(first_bytes) and not content_type.startswith(
+                    "text/html"
+                )
+        except http.client.BadStatusLine as e:
+            # Old SHOUTcast servers answer "ICY 200 OK", which isn't HTTP
+            line = str(e).strip("'\" \r\n")
+            if not line.startswith("ICY "):
+                raise
+            health["ttfb_ms"] = round((time.perf_counter() - start) * 1000)
+            health["status"] = int(line.split()[1])
+            health["alive"] = health["status"] == 200
+    except urllib.error.HTTPError as e:
+        health["status"] = e.code
+        health["error"] = f"HTTP {e.code}"
+    except Exception as e:
+        health["error"] = str(e) or type(e).__name__
+    return health
+
+
+def run(
+    stations_json,
+    health_json,
+    workers=WORKERS,
+    per_host=PER_HOST,
+    timeout=TIMEOUT_SEC,
+    verbose=True,
+):
+    with open(stations_json, "r") as read_file:
+        stations_dict = json.load(read_file)
+    urls = list(
+        dict.fromkeys(
+            station["url"]
+            for data in stations_dict.values()
+            for station in data["urls"]
+        )
+    )
+
+    # The URLs waiting for each host.  A probe is only handed to the pool once its host has a free slot,
+    # so long runs of one host in stations.json can't tie up every worker waiting for it.
+    queued = OrderedDict()
+    for url in urls:
+        queued.setdefault(Host(url), deque()).append(url)
+    limits = Host_Limits(per_host)
+
+    def probe_limited(url):
+        # Called holding a slot for the URL's host.  When a playlist leads to another host the slot is
+        # swapped for one there, so only one is ever held and waiting for it can't deadlock.
+        held = Host(url)
+
+        def before_request(request_url):
+            nonlocal held
+            host = Host(request_url)
+            if host != held:
+                limits.release(held)
+                held = None
+                limits.acquire(host)
+                held = host
+
+        try:
+            return Probe(url, timeout, before_request)
+        finally:
+            if held is not None:
+                limits.release(held)
+
+    start = time.perf_counter()
+    health = {}
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while queued or pending:
+            # Take the hosts in turn, starting as many probes as they have free slots and the pool has workers
+            for host in list(queued):
+                if len(pending) >= workers:
+                    break
+                waiting = queued[host]
+                while waiting and len(pending) < workers and limits.try_acquire(host):
+                    url = waiting.popleft()
+                    pending[executor.submit(probe_limited, url)] = url
+                if not waiting:
+                    del queued[host]
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                health[pending.pop(future)] = future.result()
+                if verbose and (len(health) % 100 == 0 or len(health) == len(urls)):
+                    print(f"Probed {len(health)} of {len(urls)}")
+
+    # Keep the order of stations.json, so the file diffs cleanly between runs
+    health = {url: health[url] for url in urls}
+    with open(health_json + ".tmp", "w", encoding="utf8") as f:
+        json.dump(health, f, indent=2, ensure_ascii=False)
+    os.replace(health_json + ".tmp", health_json)
+
+    alive = sum(entry["alive"] for entry in health.values())
+    if verbose:
+        print(
+            f"{alive} of {len(urls)} stations alive, "
+            f"probed in {time.perf_counter() - start:.1f} s, written to {health_json}"
+        )
+    return health
+
+
+def self_test():
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Stand_In(BaseHTTPRequestHandler):
+        # path: (status, headers, body)
+        routes = {
+            "/live.mp3": (
+                200,
+                {"Content-Type": "audio/mpeg", "icy-br": "128"},
+                b"\xff\xfb\x90\x64" * 64,
+            ),
+            "/live.aac": (
+                200,
+                {"Content-Type": "application/octet-stream"},
+                b"\xff\xf1\x50\x80" * 64,
+            ),
+            "/live.pls": (
+                200,
+                {"Content-Type": "audio/x-scpls"},
+                b"[playlist]\nFile1=/live.mp3\n",
+            ),
+            "/dead.pls": (
+                200,
+                {"Content-Type": "audio/x-scpls"},
+                b"[playlist]\nFile1=/missing.mp3\n",
+            ),
+            "/parked": (200, {"Content-Type": "text/html"}, b"<html>For sale</html>"),
+        }
+        active = 0
+        most_active = 0
+        hits = Counter()
+        # Where /relay/ playlists send the player, set once the server is up
+        busy = None
+        lock = threading.Lock()
+
+        def do_GET(self):
+            with Stand_In.lock:
+                Stand_In.hits[self.path] += 1
+            if self.path.startswith("/relay/"):
+                # Playlists on one host for streams on the busy one
+                status, headers, body = (
+                    200,
+                    {"Content-Type": "audio/x-scpls"},
+                    f"[playlist]\nFile1={Stand_In.busy}/busy{self.path[:-4]}.mp3\n".encode(),
+                )
+            elif self.path.startswith("/busy/"):
+                # Lots of stations on one host, to check the per host limit
+                with Stand_In.lock:
+                    Stand_In.active += 1
+                    Stand_In.most_active = max(Stand_In.most_active, Stand_In.active)
+                time.sleep(0.05)
+                with Stand_In.lock:
+                    Stand_In.active -= 1
+                status, headers, body = self.routes["/live.mp3"]
+            else:
+                if self.path == "/slow.mp3":
+                    time.sleep(2)
+                status, headers, body = self.routes.get(self.path, (404, {}, b""))
+            try:
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+            except ConnectionError:
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Stand_In)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    # The same server under another name, which counts as a separate host
+    busy = f"http://localhost:{server.server_port}"
+    Stand_In.busy = busy
+
+    stations_dict = {
+        "Testville": {
+            "coords": {"n": 0, "e": 0},
+            "urls": [
+                {"name": name, "url": base + path}
+                for name, path in [
+                    ("Live", "/live.mp3"),
+                    ("AAC", "/live.aac"),
+                    ("Playlist", "/live.pls"),
+                    ("Dead playlist", "/dead.pls"),
+                    ("Missing", "/missing.mp3"),
+                    ("Parked", "/parked"),
+                    ("Slow", "/slow.mp3"),
+                ]
+            ]
+            + [{"name": "Refused", "url": "http://127.0.0.1:9/refused.mp3"}],
+        },
+        "Busytown": {
+            "coords": {"n": 1, "e": 1},
+            "urls": [
+                {"name": str(n), "url": f"{busy}/busy/{n}.mp3"} for n in range(20)
+            ],
+        },
+        "Relayton": {
+            "coords": {"n": 2, "e": 2},
+            "urls": [
+                {"name": str(n), "url": f"{base}/relay/{n}.pls"} for n in range(10)
+            ],
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        stations_json = os.path.join(directory, "stations.json")
+        health_json = os.path.join(directory, "health.json")
+        with open(stations_json, "w") as f:
+            json.dump(stations_dict, f)
+        health = run(stations_json, health_json, per_host=2, timeout=1, verbose=False)
+        with open(health_json, "r") as f:
+            assert json.load(f) == health
+
+    def check(path, **expected):
+        entry = health[path if path.startswith("http") else base + path]
+        for key, value in expected.items():
+            assert entry[key] == value, (path, key, entry)
+
+    check("/live.mp3", alive=True, status=200, codec="mp3", bitrate_kbps=128)
+    check("/live.aac", alive=True, codec="aac", bitrate_kbps=None)
+    check("/live.pls", alive=True, codec="mp3", stream_url=base + "/live.mp3")
+    check("/dead.pls", alive=False)
+    check("/missing.mp3", alive=False, status=404)
+    check("/parked", alive=False, status=200)
+    check("/slow.mp3", alive=False, status=None)
+    check("http://127.0.0.1:9/refused.mp3", alive=False, status=None)
+    assert health[base + "/live.mp3"]["ttfb_ms"] is not None
+    assert all(health[f"{busy}/busy/{n}.mp3"]["alive"] for n in range(20))
+    assert all(health[f"{base}/relay/{n}.pls"]["alive"] for n in range(10))
+    # The limit holds for the hosts playlists lead to, and each stream is only fetched once
+    assert Stand_In.most_active <= 2, Stand_In.most_active
+    assert Stand_In.hits["/live.aac"] == 1 and Stand_In.hits["/busy/0.mp3"] == 1
+    server.shutdown()
+    print(f"Self test passed, at most {Stand_In.most_active} connections to one host")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Probe station health")
+    parser.add_argument("stations_json", nargs="?", default="stations.json")
+    parser.add_argument("health_json", nargs="?", default="health.json")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--per-host", type=int, default=PER_HOST)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT_SEC)
+    parser.add_argument("--self-test", action="store_true")
+    args = parser.parse_args()
+
+    if args.self_test:
+        self_test()
+    else:
+        run(
+            args.stations_json,
+            args.health_json,
+            args.workers,
+            args.per_host,
+            args.timeout,
+        )